@@ -0,0 +1,112 @@
+import time, json, hashlib, threading
+from collections import OrderedDict
+
+import numpy as np
+
+from proj_config import config
+from log_util import get_logger
+
+_logger = get_logger(__name__)
+
+class AnswerCache:
+    def __init__(self, max_entries, ttl, semantic_threshold):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+
+        self.hits = {"exact": 0, "semantic": 0}
+        self.misses = 0
+
+        # key -> {"created_at", "scope", "vector", "answer_data"}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(question, scope, doc_ids):
+        payload = json.dumps([question, list(scope), [str(doc_id) for doc_id in doc_ids]])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _expire(self):
+        now = time.time()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry["created_at"] <= self.ttl:
+                break
+            self._entries.pop(key)
+
+    def get_exact(self, key):
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self.hits["exact"] += 1
+            return entry["answer_data"]
+
+    def get_semantic(self, scope, vector):
+        # looked up after get_exact, so returning None here is a miss of both tiers
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+
+            self._expire()
+            candidates = [entry for entry in self._entries.values() if entry["scope"] == scope and entry["vector"] is not None]
+            if not candidates:
+                self.misses += 1
+                return None
+
+            matrix = np.vstack([entry["vector"] for entry in candidates])
+            scores = matrix @ _unit(vector)
+            best = int(np.argmax(scores))
+            if scores[best] < self.semantic_threshold:
+                self.misses += 1
+                return None
+            self.hits["semantic"] += 1
+            return candidates[best]["answer_data"]
+
+    def put(self, key, scope, vector, answer_data):
+        with self._lock:
+            # re-inserting moves the entry to the end, so the dict stays ordered by creation time
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                "created_at": time.time(),
+                "scope": scope,
+                "vector": None if vector is None else _unit(vector),
+                "answer_data": answer_data,
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "exact_hits": self.hits["exact"],
+                "semantic_hits": self.hits["semantic"],
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+def get_answer_cache():
+    global _answer_cache
+
+    if not config.answer_cache_enabled:
+        return None
+
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(
+                config.answer_cache_max_entries,
+                config.answer_cache_ttl,
+                config.answer_cache_semantic_threshold,
+            )
+            _logger.info(f"get_answer_cache: created. max_entries={config.answer_cache_max_entries}, ttl={config.answer_cache_ttl}, semantic_threshold={config.answer_cache_semantic_threshold}")
+        return _answer_cache
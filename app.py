@@ -5,93 +5,177 @@ import streamlit as st
 from proj_config import config
 from log_util import get_logger
 from ingest import ingest
+import proj_util
 import elastic_util
 import llm_util
 import db_util
 import grafana_util
+import answer_cache
+import rerank_util
 
 _logger = get_logger(__name__)
 
-def init():
-    st.write("🔍 **Checking if Elasticsearch index exists...**")
-    if not elastic_util.check_inited(st.session_state.es_client):
-        st.write("🛠️ **Elasticsearch index does not exist. Creating index...**")
-        ingest()
-        st.write("✅ **Elasticsearch index created successfully.**")
+@st.cache_resource(show_spinner=False)
+def get_es_client():
+    es_client = elastic_util.create_client()
+    if es_client is None:
+        # raising keeps the failure out of the cache, the next run retries
+        raise RuntimeError("Elasticsearch is not reachable")
+    return es_client
+
+@st.cache_resource(show_spinner=False)
+def get_llm_client():
+    llm_client = llm_util.create_client()
+    if llm_client is None:
+        raise RuntimeError("Ollama is not reachable")
+    return llm_client
+
+@st.cache_resource(show_spinner=False)
+def get_embedding_model():
+    return llm_util.create_embedding_model()
+
+@st.cache_resource(show_spinner=False)
+def get_reranker():
+    return rerank_util.create_reranker()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_books():
+    return elastic_util.get_books(get_es_client())
+
+def init(es_client, embedding_model):
+    messages = []
+
+    messages.append("🔍 **Checking if Elasticsearch index exists...**")
+    if not elastic_util.check_inited(es_client):
+        messages.append("🛠️ **Elasticsearch index does not exist. Creating index...**")
+        ingest(es_client=es_client, embedding_model=embedding_model)
+        messages.append("✅ **Elasticsearch index created successfully.**")
     else:
-        st.write("✅ **Elasticsearch index already exists.**")
+        messages.append("✅ **Elasticsearch index already exists.**")
 
-    st.write("🔍 **Checking if database tables are created...**")
+    messages.append("🔍 **Checking if database tables are created...**")
     if not db_util.check_inited():
-        st.write("🛠️ **Database tables do not exist. Creating tables...**")
+        messages.append("🛠️ **Database tables do not exist. Creating tables...**")
         db_util.init_db()
-        st.write("✅ **Database tables created successfully.**")
+        messages.append("✅ **Database tables created successfully.**")
     else:
-        st.write("✅ **Database tables already exist.**")
+        messages.append("✅ **Database tables already exist.**")
+        db_util.migrate_db()
 
-    st.write("🔍 **Checking if Grafana dashboard is set up...**")
+    messages.append("🔍 **Checking if Grafana dashboard is set up...**")
     if not grafana_util.check_inited():
-        st.write("🛠️ **Grafana dashboard is not set up. Setting up dashboard...**")
+        messages.append("🛠️ **Grafana dashboard is not set up. Setting up dashboard...**")
         grafana_util.init_grafana()
-        st.write("✅ **Grafana dashboard set up successfully.**")
+        messages.append("✅ **Grafana dashboard set up successfully.**")
     else:
-        st.write("✅ **Grafana dashboard is already set up.**")
-
-    st.write("🚀 **Application initialization complete.**")
+        messages.append("✅ **Grafana dashboard is already set up.**")
+
+    messages.append("🚀 **Application initialization complete.**")
+    return messages
+
+@st.cache_resource(show_spinner="Initializing...")
+def initialize():
+    # once per process, later sessions reuse the shared resources and the result
+    log_prefix = "initialize"
+
+    start_time = time.time()
+    # the clients below find these probes in the health cache
+    proj_util.check_services([
+        (elastic_util.ELASTIC_HOST, elastic_util.ELASTIC_PORT),
+        (llm_util.OLLAMA_HOST, llm_util.OLLAMA_PORT),
+        (db_util.POSTGRES_HOST, db_util.POSTGRES_PORT),
+        (grafana_util.GRAFANA_HOST, grafana_util.GRAFANA_PORT),
+    ])
+    es_client = get_es_client()
+    embedding_model = get_embedding_model()
+    get_llm_client()
+    if config.rerank_enabled:
+        get_reranker()
+    messages = init(es_client, embedding_model)
+
+    _logger.info(f"{log_prefix}: success. elapsed={time.time() - start_time:.2f}s")
+    return messages
 
 def app_main():
     st.title(config.proj_name)
 
-    if "initialized" not in st.session_state:
-        st.session_state.initialized = False
     if "conversation_id" not in st.session_state:
         st.session_state.conversation_id = None
-    
-    if not st.session_state.initialized:
-        with st.spinner('Initializing...'):
-            st.session_state.es_client = elastic_util.create_client()
-            st.session_state.llm_client = llm_util.create_client()
-            st.session_state.embedding_model = llm_util.create_embedding_model()
-
-            init()
 
-            st.session_state.initialized = True
-
-            time.sleep(3)
-            st.rerun()
-    else:
-        es_client = st.session_state.es_client
-        embedding_model = st.session_state.embedding_model
-        llm_client = st.session_state.llm_client
+    init_messages = initialize()
+    if "initialized" not in st.session_state:
+        with st.expander("Initialization"):
+            for message in init_messages:
+                st.write(message)
+        st.session_state.initialized = True
+
+    es_client = get_es_client()
+    embedding_model = get_embedding_model()
+    llm_client = get_llm_client()
+
+    model_status = llm_util.get_model_status()
+    if model_status["state"] == "pulling" and model_status["total"]:
+        st.info(f"Downloading {config.llm_model_name}: {(model_status['completed'] or 0) / model_status['total']:.0%}. The first answer waits for it.")
+    elif model_status["state"] in ("checking", "pulling", "loading"):
+        st.info(f"Preparing {config.llm_model_name} ({model_status['state']}). The first answer waits for it.")
+    elif model_status["state"] == "failed":
+        st.warning(f"Preparing {config.llm_model_name} failed, see the logs. It is retried with the next question.")
 
     search_type = st.radio(
         "Select search type:",
         ["knn", "hybrid", "hybrid_rrf"]
     )
 
+    book = None
+    books = get_books()
+    if len(books) > 1:
+        book = st.selectbox(
+            "Search in:",
+            [None] + sorted(books, key=books.get),
+            format_func=lambda key: "All books" if key is None else books[key]
+        )
+
     user_input = st.text_input("Enter your question: (e.g., \"What were the circumstances that led to the death of Julia Stoner?\")", key="user_input")
     if st.button("Ask"):
-        with st.spinner('Processing...'):
-            if search_type == "hybrid":
-                search_func = elastic_util.query_hybrid
-            elif search_type == "hybrid_rrf":
-                search_func = elastic_util.query_hybrid_rrf
-            else:
-                search_func = elastic_util.query_knn
-
-            question = user_input
-            answer_data = llm_util.rag(
-                search_func=functools.partial(search_func, es_client, embedding_model),
-                llm_func=functools.partial(llm_util.llm, llm_client),
-                build_prompt_func=llm_util.build_prompt,
-                query=question
-            )
-            st.write(answer_data["answer"])
-            st.write(f"Response time: {answer_data['response_time']:.2f} seconds")
-            st.write(f"Total tokens: {answer_data['total_tokens']}")
-
-            st.session_state.conversation_id = str(uuid.uuid4())
-            db_util.save_conversation(st.session_state.conversation_id, user_input, search_type, answer_data)
+        if search_type == "hybrid":
+            search_func = elastic_util.query_hybrid
+        elif search_type == "hybrid_rrf":
+            search_func = elastic_util.query_hybrid_rrf
+        else:
+            search_func = elastic_util.query_knn
+
+        search_kwargs = {"book": book}
+        rerank_func = None
+        if config.rerank_enabled:
+            # a wider candidate set, the cross-encoder keeps the best rerank_top_n for the prompt
+            search_kwargs["size"] = config.rerank_candidates
+            rerank_func = functools.partial(rerank_util.rerank, get_reranker())
+
+        question = user_input
+        answer_data = {}
+        st.write_stream(llm_util.rag_stream(
+            search_func=functools.partial(search_func, es_client, embedding_model, **search_kwargs),
+            llm_stream_func=functools.partial(llm_util.llm_stream, llm_client),
+            build_prompt_func=llm_util.build_prompt,
+            query=question,
+            answer_data=answer_data,
+            search_type=search_type,
+            embedding_model=embedding_model,
+            answer_cache=answer_cache.get_answer_cache(),
+            book=book,
+            rerank_func=rerank_func
+        ))
+        if answer_data["cached"]:
+            st.write(f"Served from cache ({answer_data['cache_tier']} match)")
+        else:
+            st.write(f"Time to first token: {answer_data['time_to_first_token']:.2f} seconds")
+            if answer_data["tokens_per_second"] is not None:
+                st.write(f"Tokens/sec: {answer_data['tokens_per_second']:.1f}")
+        st.write(f"Response time: {answer_data['response_time']:.2f} seconds (total: {answer_data['total_time']:.2f} seconds)")
+        st.write(f"Total tokens: {answer_data['total_tokens']}")
+
+        st.session_state.conversation_id = str(uuid.uuid4())
+        db_util.save_conversation(st.session_state.conversation_id, user_input, search_type, answer_data)
     
     def reset(feedback):
         db_util.save_feedback(st.session_state.conversation_id, feedback)
@@ -0,0 +1,75 @@
+import os, time
+
+import numpy as np
+from streamlit.testing.v1 import AppTest
+
+from log_util import get_logger
+import elastic_util
+import llm_util
+import db_util
+import grafana_util
+import app
+
+_logger = get_logger(__name__)
+
+SESSION_NUM = 5
+# the previous app slept this long after initializing every session
+PREVIOUS_INIT_SLEEP = 3
+
+def rss_mb():
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+def bench_sessions():
+    # every AppTest is a new browser session in this process, kept alive like a connected user
+    sessions = []
+    times = []
+    rss = [rss_mb()]
+    for _ in range(SESSION_NUM):
+        at = AppTest.from_file("app.py", default_timeout=600)
+        start_time = time.perf_counter()
+        at.run()
+        times.append(time.perf_counter() - start_time)
+        if at.exception or not at.text_input:
+            raise RuntimeError(f"bench_sessions: app failed! exception={at.exception}")
+        sessions.append(at)
+        rss.append(rss_mb())
+    return np.array(times), np.diff(rss)
+
+def bench_per_session_resources():
+    # what each session built for itself before: three clients, the model and the init checks
+    resources = []
+    times = []
+    rss = [rss_mb()]
+    for _ in range(2):
+        start_time = time.perf_counter()
+        es_client = elastic_util.create_client()
+        embedding_model = llm_util.create_embedding_model()
+        resources.append((es_client, llm_util.create_client(), embedding_model))
+        app.init(es_client, embedding_model)
+        times.append(time.perf_counter() - start_time + PREVIOUS_INIT_SLEEP)
+        rss.append(rss_mb())
+    return np.array(times), np.diff(rss)
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+    llm_util.OLLAMA_HOST = "localhost"
+    llm_util.OLLAMA_PORT = int(os.getenv("OLLAMA_LOCAL_PORT", 11434))
+    db_util.POSTGRES_HOST = "localhost"
+    db_util.POSTGRES_PORT = int(os.getenv("POSTGRES_LOCAL_PORT", 5432))
+    grafana_util.GRAFANA_HOST = "localhost"
+    grafana_util.GRAFANA_PORT = int(os.getenv("GRAFANA_LOCAL_PORT", 3000))
+
+    times, rss_deltas = bench_sessions()
+    _logger.info(f"shared: first session={times[0]:.2f}s, next sessions mean={times[1:].mean():.3f}s, rss first session=+{rss_deltas[0]:.0f}MB, rss per next session=+{rss_deltas[1:].mean():.1f}MB")
+
+    previous_times, previous_rss_deltas = bench_per_session_resources()
+    _logger.info(f"per-session (previous): session={previous_times.mean():.2f}s (incl. {PREVIOUS_INIT_SLEEP}s sleep), rss per session=+{previous_rss_deltas[1:].mean():.0f}MB")
@@ -0,0 +1,49 @@
+import os, time
+
+import numpy as np
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+import search_backend
+import eval_retrieval
+
+_logger = get_logger(__name__)
+
+def run(backend, questions):
+    results = []
+    latencies = []
+    for question in questions:
+        start_time = time.perf_counter()
+        hits = backend.keyword([question], config.elastic_result_num)[0]
+        latencies.append(time.perf_counter() - start_time)
+        results.append([hit["_source"] for hit in hits])
+    return results, np.array(latencies) * 1000
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+
+    df_ground_truth = pd.read_csv(config.ground_truth_file_path)
+    questions = df_ground_truth["question"].tolist()
+    doc_ids = df_ground_truth["document"].tolist()
+
+    es_client = elastic_util.create_client()
+    es_results, es_latencies = run(elastic_util.ElasticBackend(es_client), questions)
+    local_results, local_latencies = run(search_backend.get_local_backend(), questions)
+
+    # ranking parity against elasticsearch on the ground-truth questions
+    k = config.elastic_result_num
+    same_ranking = np.mean([[d["id"] for d in a] == [d["id"] for d in b] for a, b in zip(es_results, local_results)])
+    same_top1 = np.mean([bool(a) and bool(b) and a[0]["id"] == b[0]["id"] for a, b in zip(es_results, local_results)])
+    overlap = np.mean([len({d["id"] for d in a} & {d["id"] for d in b}) / max(len(a), 1) for a, b in zip(es_results, local_results)])
+    _logger.info(f"parity: questions#={len(questions)}, same_ranking={same_ranking:.3f}, same_top1={same_top1:.3f}, overlap@{k}={overlap:.3f}")
+
+    for name, results, latencies in [("elastic", es_results, es_latencies), ("local", local_results, local_latencies)]:
+        relevance = eval_retrieval.relevance_matrix(results, doc_ids, k)
+        _logger.info(f"{name}: hit_rate={eval_retrieval.hit_rate(relevance):.3f}, mrr={eval_retrieval.mrr(relevance):.3f}, p50={np.percentile(latencies, 50):.2f}ms, p95={np.percentile(latencies, 95):.2f}ms")
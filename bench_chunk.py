@@ -0,0 +1,48 @@
+import time
+
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import ingest
+import chunk_util
+
+_logger = get_logger(__name__)
+
+# the story repeated, standing in for larger corpora
+SCALES = [1, 4, 16, 64]
+
+def chunk_serial(content):
+    # previous path: one chunker call over the whole text
+    return chunk_util.chunk_segment(content)
+
+def timed(func, content):
+    start_time = time.perf_counter()
+    chunks = func(content)
+    return chunks, time.perf_counter() - start_time
+
+if __name__ == "__main__":
+    content = ingest.load_text()
+
+    # load the tokenizer before timing
+    chunk_util.chunk_segment(content[:1000])
+
+    rows = []
+    for scale in SCALES:
+        text = content * scale
+        serial_chunks, serial_time = timed(chunk_serial, text)
+        parallel_chunks, parallel_time = timed(ingest.chunk, text)
+        rows.append({
+            "scale": scale,
+            "mb": len(text) / 2**20,
+            "segments": len(list(chunk_util.split_segments(text.splitlines(keepends=True), config.chunk_segment_chars))),
+            "serial_chunks/sec": len(serial_chunks) / serial_time,
+            "parallel_chunks/sec": len(parallel_chunks) / parallel_time,
+            "speedup": serial_time / parallel_time,
+            # chunks only differ where a segment boundary forced a break
+            "chunks_diff": len(parallel_chunks) - len(serial_chunks),
+            "deterministic": ingest.chunk(text) == parallel_chunks,
+        })
+
+    df_report = pd.DataFrame(rows)
+    _logger.info(f"chunking (workers={config.chunk_workers}, segment_chars={config.chunk_segment_chars}):\n{df_report.round(2).to_string(index=False)}")
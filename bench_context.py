@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+import llm_util
+
+_logger = get_logger(__name__)
+
+RESULT_NUMS = [5, 10]
+
+def run(llm_client, embedding_model, samples, search_results, assembly):
+    config.context_assembly = assembly
+    rows = []
+    for record, docs in zip(samples, search_results):
+        prompt_stats = {}
+        prompt = llm_util.build_prompt(record["question"], docs, prompt_stats)
+        answer, tokens, response_time = llm_util.llm(llm_client, prompt)
+        rows.append({
+            "question": record["question"],
+            "answer": answer,
+            "document": record["document"],
+            "context_tokens": prompt_stats["context_tokens"],
+            "prompt_tokens": tokens["prompt_tokens"],
+            "response_time": response_time,
+        })
+    df = pd.DataFrame(rows)
+
+    # answer relevance proxy: similarity of the answer to the question it answers
+    vectors = embedding_model.encode(df["question"].tolist() + df["answer"].tolist(), batch_size=config.embedding_batch_size, normalize_embeddings=True)
+    df["answer_cos"] = np.sum(vectors[:len(df)] * vectors[len(df):], axis=1)
+    return df
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+    llm_util.OLLAMA_HOST = "localhost"
+    llm_util.OLLAMA_PORT = int(os.getenv("OLLAMA_LOCAL_PORT", 11434))
+
+    es_client = elastic_util.create_client()
+    llm_client = llm_util.create_client()
+    embedding_model = llm_util.create_embedding_model()
+
+    # same sample as llm_results.py
+    df_ground_truth = pd.read_csv(config.ground_truth_file_path)
+    samples = df_ground_truth.groupby('document').head(1).sample(n=config.llm_results_num, random_state=1).to_dict(orient='records')
+
+    rows = []
+    for result_num in RESULT_NUMS:
+        config.elastic_result_num = result_num
+        search_results = [elastic_util.query_hybrid_rrf(es_client, embedding_model, record["question"]) for record in samples]
+        for name, assembly in [("concat", False), ("assembled", True)]:
+            df = run(llm_client, embedding_model, samples, search_results, assembly)
+            # same columns as llm_results.py, for the relevance judge in eval_rag.ipynb
+            df[["question", "answer", "document"]].to_csv(f"context-results-{name}-k{result_num}.csv", index=False)
+            rows.append({
+                "result_num": result_num,
+                "context": name,
+                "context_tokens": df["context_tokens"].mean(),
+                "prompt_tokens": df["prompt_tokens"].mean(),
+                "response_time_s": df["response_time"].mean(),
+                "answer_cos": df["answer_cos"].mean(),
+            })
+
+    df_report = pd.DataFrame(rows)
+    _logger.info(f"context assembly (questions#={len(samples)}, budget={config.context_token_budget}):\n{df_report.round(3).to_string(index=False)}")
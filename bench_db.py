@@ -0,0 +1,55 @@
+import os, time
+
+import numpy as np
+
+from proj_config import config
+from log_util import get_logger
+import db_util
+
+_logger = get_logger(__name__)
+
+CALL_NUM = 200
+
+def select_key(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT value FROM keyvalues WHERE key = %s", (config.grafana_api_key_name,))
+        cur.fetchone()
+
+def call_unpooled():
+    # previous behavior: service probe + new connection per statement
+    conn = db_util.create_connection()
+    try:
+        select_key(conn)
+    finally:
+        conn.close()
+
+def call_pooled():
+    conn = db_util.get_connection()
+    try:
+        select_key(conn)
+    finally:
+        db_util.release_connection(conn)
+
+def bench(name, call_func):
+    latencies = []
+    for _ in range(CALL_NUM):
+        start_time = time.perf_counter()
+        call_func()
+        latencies.append(time.perf_counter() - start_time)
+
+    latencies = np.array(latencies) * 1000
+    _logger.info(f"bench: {name}. calls#={CALL_NUM}, p50={np.percentile(latencies, 50):.2f}ms, p95={np.percentile(latencies, 95):.2f}ms, mean={latencies.mean():.2f}ms")
+    return latencies.mean()
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    db_util.POSTGRES_HOST = "localhost"
+    db_util.POSTGRES_PORT = int(os.getenv("POSTGRES_LOCAL_PORT", 5432))
+
+    unpooled_mean = bench("unpooled", call_unpooled)
+    call_pooled() # create the pool outside the measurement
+    pooled_mean = bench("pooled", call_pooled)
+    _logger.info(f"bench: per-call latency reduction={unpooled_mean - pooled_mean:.2f}ms ({unpooled_mean / pooled_mean:.1f}x)")
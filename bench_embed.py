@@ -0,0 +1,48 @@
+import time
+
+import numpy as np
+
+from proj_config import config
+from log_util import get_logger
+import ingest
+import llm_util
+
+_logger = get_logger(__name__)
+
+BATCH_SIZES = [8, 16, 32, 64]
+
+def bench_per_chunk(chunks, embedding_model):
+    start_time = time.time()
+    vectors = [embedding_model.encode(chunk) for chunk in chunks]
+    elapsed = time.time() - start_time
+    return np.vstack(vectors).astype(np.float32), elapsed
+
+def bench_batched(chunks, embedding_model, batch_size):
+    start_time = time.time()
+    vectors = embedding_model.encode(
+        chunks,
+        batch_size=batch_size,
+        normalize_embeddings=config.embedding_normalize,
+        convert_to_numpy=True,
+    )
+    elapsed = time.time() - start_time
+    return np.ascontiguousarray(vectors, dtype=np.float32), elapsed
+
+if __name__ == "__main__":
+    log_prefix = "bench_embed"
+
+    chunks = ingest.chunk(ingest.load_text())
+    embedding_model = llm_util.create_embedding_model(device="cpu")
+
+    # warm up tokenizer and weights so the first measurement is not penalized
+    embedding_model.encode(chunks[:8])
+
+    base_vectors, base_elapsed = bench_per_chunk(chunks, embedding_model)
+    _logger.info(f"{log_prefix}: per_chunk. chunks#={len(chunks)}, elapsed={base_elapsed:.2f}s, chunks/sec={len(chunks) / base_elapsed:.1f}")
+
+    base_norm = base_vectors / np.linalg.norm(base_vectors, axis=1, keepdims=True)
+    for batch_size in BATCH_SIZES:
+        vectors, elapsed = bench_batched(chunks, embedding_model, batch_size)
+        norm = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        min_cos = float(np.min(np.sum(base_norm * norm, axis=1)))
+        _logger.info(f"{log_prefix}: batched. batch_size={batch_size}, elapsed={elapsed:.2f}s, chunks/sec={len(chunks) / elapsed:.1f}, speedup={base_elapsed / elapsed:.2f}x, min_cos={min_cos:.6f}")
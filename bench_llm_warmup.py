@@ -0,0 +1,64 @@
+import os, time
+
+import pandas as pd
+import requests
+
+from proj_config import config
+from log_util import get_logger
+import llm_util
+
+_logger = get_logger(__name__)
+
+QUESTION_NUM = 3
+
+def unload_model(ollama_url):
+    # keep_alive 0 evicts the model right away, the next request starts cold
+    requests.post(f"{ollama_url}/api/generate", json={"model": config.llm_model_name, "keep_alive": 0}).raise_for_status()
+
+def first_answer(llm_client, question):
+    stats = {}
+    for _ in llm_util.llm_stream(llm_client, question, stats):
+        pass
+    return stats["time_to_first_token"], stats["response_time"]
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    llm_util.OLLAMA_HOST = "localhost"
+    llm_util.OLLAMA_PORT = int(os.getenv("OLLAMA_LOCAL_PORT", 11434))
+    ollama_url = llm_util.get_ollama_url()
+
+    # client setup: the previous blocking registry pull vs. the local model check
+    start_time = time.perf_counter()
+    requests.post(f"{ollama_url}/api/pull", json={"name": config.llm_model_name, "stream": False}).raise_for_status()
+    pull_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    present = llm_util.check_model(ollama_url)
+    check_time = time.perf_counter() - start_time
+    _logger.info(f"client setup: blocking pull={pull_time:.2f}s, local check={check_time * 1000:.1f}ms (present={present})")
+
+    config.llm_warm_up = False
+    llm_client = llm_util.create_client()
+    llm_util.wait_model()
+
+    questions = pd.read_csv(config.ground_truth_file_path)["question"].head(QUESTION_NUM).tolist()
+    rows = []
+    for question in questions:
+        unload_model(ollama_url)
+        cold_ttft, cold_total = first_answer(llm_client, question)
+
+        unload_model(ollama_url)
+        warm_up_time = llm_util.warm_up_model(ollama_url)
+        warm_ttft, warm_total = first_answer(llm_client, question)
+        rows.append({
+            "cold_ttft_s": cold_ttft,
+            "cold_total_s": cold_total,
+            "warm_up_s": warm_up_time,
+            "warm_ttft_s": warm_ttft,
+            "warm_total_s": warm_total,
+        })
+
+    df_report = pd.DataFrame(rows)
+    _logger.info(f"first answer, cold vs. warm model (questions#={len(questions)}):\n{df_report.round(2).to_string(index=False)}\nmean:\n{df_report.mean().round(2).to_string()}")
@@ -0,0 +1,78 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import ingest
+import llm_util
+import onnx_embedding
+
+_logger = get_logger(__name__)
+
+QUESTION_NUM = 100
+
+# name -> (backend, onnx int8 quantization)
+VARIANTS = {
+    "torch": ("torch", False),
+    "onnx": ("onnx", False),
+    "onnx_int8": ("onnx", True),
+}
+
+def load(backend, quantized):
+    config.embedding_onnx_quantize = quantized
+    start_time = time.perf_counter()
+    embedding_model = llm_util.create_embedding_model(device="cpu", backend=backend)
+    return embedding_model, time.perf_counter() - start_time
+
+def bench_single(embedding_model, questions):
+    latencies = []
+    for question in questions:
+        start_time = time.perf_counter()
+        embedding_model.encode(question)
+        latencies.append(time.perf_counter() - start_time)
+    return np.array(latencies) * 1000
+
+def bench_batch(embedding_model, chunks):
+    start_time = time.perf_counter()
+    vectors = embedding_model.encode(
+        chunks,
+        batch_size=config.embedding_batch_size,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+    )
+    return np.asarray(vectors, dtype=np.float32), time.perf_counter() - start_time
+
+if __name__ == "__main__":
+    chunks = ingest.chunk(ingest.load_text())
+    questions = pd.read_csv(config.ground_truth_file_path)["question"].head(QUESTION_NUM).tolist()
+
+    # export and quantize up front, so load time is the steady-state startup cost
+    onnx_embedding.prepare(config.embedding_model_name, config.embedding_onnx_dir, quantized=True)
+
+    rows = []
+    base_vectors = None
+    for name, (backend, quantized) in VARIANTS.items():
+        embedding_model, load_time = load(backend, quantized)
+        # warm up
+        embedding_model.encode(chunks[:8])
+
+        latencies = bench_single(embedding_model, questions)
+        vectors, elapsed = bench_batch(embedding_model, chunks)
+        if base_vectors is None:
+            base_vectors = vectors
+        cos = np.sum(base_vectors * vectors, axis=1)
+        rows.append({
+            "variant": name,
+            "load_s": load_time,
+            "query_p50_ms": float(np.percentile(latencies, 50)),
+            "query_p95_ms": float(np.percentile(latencies, 95)),
+            "chunks/sec": len(chunks) / elapsed,
+            "mean_cos": float(cos.mean()),
+            "min_cos": float(cos.min()),
+        })
+        del embedding_model
+
+    df_report = pd.DataFrame(rows).set_index("variant")
+    _logger.info(f"embedding backends (chunks#={len(chunks)}, questions#={len(questions)}, threads={config.embedding_onnx_threads}):\n{df_report.round(4).to_string()}")
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pandas as pd
+import requests
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+import llm_util
+import context_util
+
+_logger = get_logger(__name__)
+
+QUESTION_NUM = 20
+
+def build_prompt_previous(query, search_results, stats=None):
+    # previous layout: one user message, the question before the context
+    prompt_template = """
+You are an expert detective analyzing the details of the story "The Adventure of the Speckled Band." Answer the QUESTION using only the relevant information provided in the CONTEXT from the story.
+
+Make sure to stay true to the facts in the CONTEXT when answering the QUESTION. Avoid adding any outside knowledge or assumptions.
+
+QUESTION: {question}
+
+CONTEXT:
+{context}
+""".strip()
+
+    context, _ = context_util.assemble_context(search_results)
+    return prompt_template.format(question=query, context=context).strip()
+
+def prefill(ollama_url, messages):
+    # ollama's native api reports the prompt tokens it evaluated and how long that took
+    response = requests.post(f"{ollama_url}/api/chat", json={
+        "model": config.llm_model_name,
+        "messages": messages,
+        "stream": False,
+        "options": {"num_predict": 1},
+    })
+    response.raise_for_status()
+    result = response.json()
+    return result.get("prompt_eval_count", 0), result.get("prompt_eval_duration", 0) / 1e6
+
+def time_to_first_token(llm_client, messages):
+    stats = {}
+    for _ in llm_util.llm_stream(llm_client, messages, stats):
+        pass
+    return stats["time_to_first_token"]
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+    llm_util.OLLAMA_HOST = "localhost"
+    llm_util.OLLAMA_PORT = int(os.getenv("OLLAMA_LOCAL_PORT", 11434))
+
+    es_client = elastic_util.create_client()
+    llm_client = llm_util.create_client()
+    embedding_model = llm_util.create_embedding_model()
+    llm_util.wait_model()
+    ollama_url = llm_util.get_ollama_url()
+
+    questions = pd.read_csv(config.ground_truth_file_path)["question"].head(QUESTION_NUM).tolist()
+    search_results = [elastic_util.query_hybrid_rrf(es_client, embedding_model, question) for question in questions]
+
+    rows = []
+    for name, build_prompt_func in [("previous", build_prompt_previous), ("system_prefix", llm_util.build_prompt)]:
+        prompt_tokens = []
+        prefill_ms = []
+        ttfts = []
+        messages_list = [llm_util.to_messages(build_prompt_func(question, docs)) for question, docs in zip(questions, search_results)]
+        for messages in messages_list:
+            count, duration = prefill(ollama_url, messages)
+            prompt_tokens.append(count)
+            prefill_ms.append(duration)
+        # own pass, so each request follows the previous question's prompt, not its own prefill
+        for messages in messages_list:
+            ttfts.append(time_to_first_token(llm_client, messages))
+        # the first request of each pass follows another prompt, the rest show the reuse between questions
+        rows.append({
+            "layout": name,
+            "prefilled_tokens": float(np.mean(prompt_tokens[1:])),
+            "prefill_p50_ms": float(np.percentile(prefill_ms[1:], 50)),
+            "ttft_p50_s": float(np.percentile(ttfts[1:], 50)),
+            "ttft_p95_s": float(np.percentile(ttfts[1:], 95)),
+        })
+
+    df_report = pd.DataFrame(rows).set_index("layout")
+    _logger.info(f"prefill (questions#={len(questions)}, model={config.llm_model_name}):\n{df_report.round(3).to_string()}")
@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+import llm_util
+import eval_retrieval
+import sweep_knn
+from vector_index import VectorIndex
+
+_logger = get_logger(__name__)
+
+# name -> (vector index type, rescore oversample)
+VARIANTS = {
+    "float32": ("hnsw", None),
+    "int8": ("int8_hnsw", None),
+    "int8_rescore": ("int8_hnsw", 2.0),
+}
+
+# off-heap bytes per vector the hnsw search wants in the page cache (elasticsearch sizing guide)
+VECTOR_BYTES = {
+    "hnsw": lambda dims: dims * 4,
+    "int8_hnsw": lambda dims: dims + 4,
+}
+
+def run(es_client, index_name, vectors, oversample):
+    config.knn_rescore_oversample = oversample
+    results = []
+    latencies = []
+    for start in range(0, len(vectors), config.eval_batch_size):
+        searches = []
+        for v in vectors[start:start + config.eval_batch_size]:
+            searches.extend([{}, elastic_util.knn_search_body(v, config.elastic_result_num)])
+        for response in es_client.msearch(index=index_name, searches=searches)["responses"]:
+            if "error" in response:
+                raise RuntimeError(f"run: failed! error={response['error']}")
+            results.append([hit["_source"] for hit in response["hits"]["hits"]])
+            latencies.append(response["took"])
+    return results, np.array(latencies, dtype=np.float64)
+
+def index_size(es_client, index_name, index_type, docs_num, dims):
+    store = es_client.indices.stats(index=index_name, metric="store")["indices"][index_name]["total"]["store"]["size_in_bytes"]
+    disk_usage = es_client.indices.disk_usage(index=index_name, run_expensive_tasks=True)[index_name]
+    return {
+        "store_mb": store / 2**20,
+        "vector_field_mb": disk_usage["fields"]["vector"]["total_in_bytes"] / 2**20,
+        # vectors plus the hnsw graph links
+        "est_offheap_mb": docs_num * (VECTOR_BYTES[index_type](dims) + 4 * config.hnsw_m) / 2**20,
+    }
+
+def heap_used_mb(es_client):
+    nodes = es_client.nodes.stats(metric="jvm")["nodes"]
+    return sum(node["jvm"]["mem"]["heap_used_in_bytes"] for node in nodes.values()) / 2**20
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+
+    df_ground_truth = pd.read_csv(config.ground_truth_file_path)
+    questions = df_ground_truth["question"].tolist()
+    doc_ids = df_ground_truth["document"].tolist()
+
+    es_client = elastic_util.create_client()
+    embedding_model = llm_util.create_embedding_model()
+    vectors = eval_retrieval.encode_questions(embedding_model, questions)
+
+    k = config.elastic_result_num
+    local_index = VectorIndex.load(config.local_index_dir, mmap=False)
+    docs_num, dims = local_index.vectors.shape
+    exact_rows, _ = local_index.search(vectors, k)
+    exact_ids = [[local_index.docs[row]["id"] for row in rows] for rows in exact_rows]
+
+    index_names = {}
+    rows = []
+    try:
+        for index_type in sorted({index_type for index_type, _ in VARIANTS.values()}):
+            index_names[index_type] = sweep_knn.build_sweep_index(es_client, local_index, config.hnsw_m, config.hnsw_ef_construction, index_type)
+
+        for name, (index_type, oversample) in VARIANTS.items():
+            index_name = index_names[index_type]
+            results, latencies = run(es_client, index_name, vectors, oversample)
+            relevance = eval_retrieval.relevance_matrix(results, doc_ids, k)
+            rows.append({
+                "variant": name,
+                f"recall@{k}": float(np.mean([len({d["id"] for d in docs} & set(exact)) / k for docs, exact in zip(results, exact_ids)])),
+                "hit_rate": eval_retrieval.hit_rate(relevance),
+                "mrr": eval_retrieval.mrr(relevance),
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p95_ms": float(np.percentile(latencies, 95)),
+                **index_size(es_client, index_name, index_type, docs_num, dims),
+                "heap_used_mb": heap_used_mb(es_client),
+            })
+    finally:
+        for index_name in index_names.values():
+            es_client.indices.delete(index=index_name, ignore_unavailable=True)
+
+    df_report = pd.DataFrame(rows).set_index("variant")
+    baseline = df_report.loc["float32"]
+    for column in ["hit_rate", "mrr"]:
+        df_report[f"{column}_delta"] = df_report[column] - baseline[column]
+    df_report["store_ratio"] = df_report["store_mb"] / baseline["store_mb"]
+    _logger.info(f"quantization report (k={k}, questions#={len(questions)}, docs#={docs_num}, dims={dims}):\n{df_report.round(3).to_string()}")
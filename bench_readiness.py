@@ -0,0 +1,50 @@
+import os, time
+
+import numpy as np
+
+from log_util import get_logger
+import proj_util
+
+_logger = get_logger(__name__)
+
+CALL_NUM = 1000
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    services = [
+        ("localhost", int(os.getenv("ELASTIC_LOCAL_PORT", 9200))),
+        ("localhost", int(os.getenv("OLLAMA_LOCAL_PORT", 11434))),
+        ("localhost", int(os.getenv("POSTGRES_LOCAL_PORT", 5432))),
+        ("localhost", int(os.getenv("GRAFANA_LOCAL_PORT", 3000))),
+    ]
+
+    # startup: one dependency after the other vs. all at once
+    proj_util.clear_health_cache()
+    start_time = time.perf_counter()
+    serial_results = [proj_util.check_service(*service) for service in services]
+    serial_time = time.perf_counter() - start_time
+
+    proj_util.clear_health_cache()
+    start_time = time.perf_counter()
+    concurrent_results = proj_util.check_services(services)
+    concurrent_time = time.perf_counter() - start_time
+    _logger.info(f"startup: serial={serial_time * 1000:.1f}ms ({sum(serial_results)}/{len(services)} up), concurrent={concurrent_time * 1000:.1f}ms ({sum(concurrent_results.values())}/{len(services)} up)")
+
+    # request path: a tcp probe per call vs. the cached healthy status
+    host, port = services[2]
+    probe_times = []
+    for _ in range(CALL_NUM):
+        start_time = time.perf_counter()
+        proj_util.probe(host, port)
+        probe_times.append(time.perf_counter() - start_time)
+    cached_times = []
+    for _ in range(CALL_NUM):
+        start_time = time.perf_counter()
+        proj_util.check_service(host, port)
+        cached_times.append(time.perf_counter() - start_time)
+    probe_times = np.array(probe_times) * 1e6
+    cached_times = np.array(cached_times) * 1e6
+    _logger.info(f"per-request check (calls#={CALL_NUM}): probe p50={np.percentile(probe_times, 50):.1f}us, p95={np.percentile(probe_times, 95):.1f}us; cached p50={np.percentile(cached_times, 50):.1f}us, p95={np.percentile(cached_times, 95):.1f}us")
@@ -0,0 +1,115 @@
+import os, time, argparse, functools
+
+import numpy as np
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+import llm_util
+import rerank_util
+import context_util
+import eval_retrieval
+
+_logger = get_logger(__name__)
+
+def run(es_client, embedding_model, reranker, search_type, questions, doc_ids, size, top_n=None, budget_ms=None):
+    # one question at a time, as the app sends them; top_n=None: no rerank
+    query_func = elastic_util.SEARCH_TYPES[search_type][0]
+    fallbacks_before = rerank_util.get_rerank_stats()["fallbacks"]
+    results = []
+    search_ms = []
+    rerank_ms = []
+    for question in questions:
+        start_time = time.perf_counter()
+        docs = query_func(es_client, embedding_model, question, size=size)
+        search_time = time.perf_counter()
+        if top_n is not None:
+            docs = rerank_util.rerank(reranker, question, docs, top_n, budget_ms)
+        search_ms.append((search_time - start_time) * 1000)
+        rerank_ms.append((time.perf_counter() - search_time) * 1000)
+        results.append(docs)
+
+    k = top_n or size
+    relevance = eval_retrieval.relevance_matrix(results, doc_ids, k)
+    total_ms = np.array(search_ms) + np.array(rerank_ms)
+    return results, {
+        "k": k,
+        "hit_rate": eval_retrieval.hit_rate(relevance),
+        "mrr": eval_retrieval.mrr(relevance),
+        "recall@1": eval_retrieval.recall_at_k(relevance, 1),
+        "context_tokens": float(np.mean([context_util.count_tokens(context_util.concat_context(docs)) for docs in results])),
+        "search_p50_ms": float(np.percentile(search_ms, 50)),
+        "rerank_p50_ms": float(np.percentile(rerank_ms, 50)),
+        "rerank_p95_ms": float(np.percentile(rerank_ms, 95)),
+        "total_p50_ms": float(np.percentile(total_ms, 50)),
+        "total_p95_ms": float(np.percentile(total_ms, 95)),
+        "fallbacks#": rerank_util.get_rerank_stats()["fallbacks"] - fallbacks_before,
+    }
+
+def run_llm(es_client, embedding_model, llm_client, reranker, search_type, questions, size, top_n=None, budget_ms=None):
+    # end to end through llm_util.rag, answer cache off
+    query_func = elastic_util.SEARCH_TYPES[search_type][0]
+    rerank_func = None
+    if top_n is not None:
+        rerank_func = lambda question, docs: rerank_util.rerank(reranker, question, docs, top_n, budget_ms)
+    rows = [llm_util.rag(
+        search_func=functools.partial(query_func, es_client, embedding_model, size=size),
+        llm_func=functools.partial(llm_util.llm, llm_client),
+        build_prompt_func=llm_util.build_prompt,
+        query=question,
+        rerank_func=rerank_func,
+    ) for question in questions]
+    return {
+        "llm_prompt_tokens": float(np.mean([row["prompt_tokens"] for row in rows])),
+        "llm_total_s": float(np.mean([row["total_time"] for row in rows])),
+    }
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--search-type", choices=list(elastic_util.SEARCH_TYPES), default="hybrid_rrf")
+    parser.add_argument("--llm", type=int, default=0, help="also time answers end to end for this many questions per variant (needs ollama)")
+    args = parser.parse_args()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+    llm_util.OLLAMA_HOST = "localhost"
+    llm_util.OLLAMA_PORT = int(os.getenv("OLLAMA_LOCAL_PORT", 11434))
+
+    es_client = elastic_util.create_client()
+    embedding_model = llm_util.create_embedding_model()
+    reranker = rerank_util.create_reranker()
+    llm_client = llm_util.create_client() if args.llm else None
+
+    df_ground_truth = pd.read_csv(config.ground_truth_file_path)
+    questions = df_ground_truth['question'].tolist()
+    doc_ids = df_ground_truth['document'].tolist()
+
+    # first forward pass loads the weights, query vectors are cached for every variant
+    rerank_util.rerank(reranker, questions[0], elastic_util.SEARCH_TYPES[args.search_type][0](es_client, embedding_model, questions[0]), budget_ms=None)
+    for question in questions:
+        elastic_util.encode_query(embedding_model, question)
+
+    candidates, top_n = config.rerank_candidates, config.rerank_top_n
+    variants = [
+        (f"retriever top {config.elastic_result_num}", config.elastic_result_num, None, None, True),
+        (f"retriever top {top_n}", top_n, None, None, True),
+        (f"rerank {candidates} -> {top_n}, budget {config.rerank_budget_ms}ms", candidates, top_n, config.rerank_budget_ms, True),
+        (f"rerank {candidates} -> {top_n}, no budget", candidates, top_n, None, True),
+        (f"rerank {candidates} -> {top_n}, cached scores", candidates, top_n, config.rerank_budget_ms, False),
+    ]
+    rows = []
+    for name, size, variant_top_n, budget_ms, cold in variants:
+        if cold:
+            rerank_util.clear_rerank_cache()
+        _, metrics = run(es_client, embedding_model, reranker, args.search_type, questions, doc_ids, size, variant_top_n, budget_ms)
+        if args.llm:
+            metrics.update(run_llm(es_client, embedding_model, llm_client, reranker, args.search_type, questions[:args.llm], size, variant_top_n, budget_ms))
+        rows.append(dict(variant=name, **metrics))
+
+    df_report = pd.DataFrame(rows)
+    _logger.info(f"rerank trade-off (search_type={args.search_type}, model={config.rerank_model_name}, questions#={len(questions)}):\n{df_report.round(3).to_string(index=False)}")
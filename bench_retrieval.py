@@ -0,0 +1,111 @@
+import os, time
+
+import numpy as np
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+import llm_util
+import search_backend
+
+_logger = get_logger(__name__)
+
+QUESTION_NUM = 100
+
+def query_hybrid_rrf_serial(es_client, embedding_model, question):
+    # previous implementation: two searches, then one get() per fused result
+    v = embedding_model.encode(question)
+    k, num_candidates = elastic_util.knn_params(config.elastic_result_num * 2)
+    knn_query = {
+        "field": "vector",
+        "query_vector": v,
+        "k": k,
+        "num_candidates": num_candidates,
+        "boost": 0.5
+    }
+    keyword_query = {
+        "bool": {
+            "must": {
+                "multi_match": {
+                    "query": question,
+                    "fields": ["text"],
+                    "type": "best_fields",
+                    "boost": 0.5,
+                }
+            }
+        }
+    }
+    knn_results = es_client.search(
+        index=config.elastic_index_name,
+        body={"knn": knn_query, "size": config.elastic_result_num * 2}
+    )['hits']['hits']
+    keyword_results = es_client.search(
+        index=config.elastic_index_name,
+        body={"query": keyword_query, "size": config.elastic_result_num * 2}
+    )['hits']['hits']
+
+    rrf_scores = {}
+    for rank, hit in enumerate(knn_results):
+        rrf_scores[hit['_id']] = elastic_util.compute_rrf(rank + 1)
+    for rank, hit in enumerate(keyword_results):
+        rrf_scores[hit['_id']] = rrf_scores.get(hit['_id'], 0) + elastic_util.compute_rrf(rank + 1)
+    reranked_docs = sorted(rrf_scores.items(), key=lambda x: x[1], reverse=True)
+
+    final_results = []
+    for doc_id, score in reranked_docs[:config.elastic_result_num]:
+        doc = es_client.get(index=config.elastic_index_name, id=doc_id)
+        final_results.append(doc['_source'])
+    return final_results
+
+def bench(name, search_func, es_client, embedding_model, questions):
+    log_prefix = "bench"
+
+    latencies = []
+    results = []
+    for question in questions:
+        start_time = time.perf_counter()
+        results.append(search_func(es_client, embedding_model, question))
+        latencies.append(time.perf_counter() - start_time)
+
+    latencies = np.array(latencies) * 1000
+    _logger.info(f"{log_prefix}: {name}. queries#={len(questions)}, p50={np.percentile(latencies, 50):.1f}ms, p95={np.percentile(latencies, 95):.1f}ms, mean={latencies.mean():.1f}ms")
+    return results
+
+class FixedEmbeddingModel:
+    # pre-computed query vectors, so the benchmark measures retrieval only
+    def __init__(self, embedding_model, questions):
+        vectors = embedding_model.encode(questions, batch_size=config.embedding_batch_size)
+        self.vectors = {elastic_util.normalize_question(q): v for q, v in zip(questions, vectors)}
+
+    def encode(self, question):
+        return self.vectors[elastic_util.normalize_question(question)]
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+
+    df_ground_truth = pd.read_csv(config.ground_truth_file_path)
+    questions = df_ground_truth["question"].head(QUESTION_NUM).tolist()
+
+    es_client = elastic_util.create_client()
+    embedding_model = FixedEmbeddingModel(llm_util.create_embedding_model(), questions)
+
+    serial_results = bench("hybrid_rrf_serial", query_hybrid_rrf_serial, es_client, embedding_model, questions)
+    msearch_results = bench("hybrid_rrf_msearch", elastic_util.query_hybrid_rrf, es_client, embedding_model, questions)
+
+    same_num = sum([d["id"] for d in a] == [d["id"] for d in b] for a, b in zip(serial_results, msearch_results))
+    _logger.info(f"same ranking: {same_num}/{len(questions)}")
+
+    if search_backend.check_local_index():
+        config.knn_backend = "elastic"
+        elastic_results = bench("knn_elastic", elastic_util.query_knn, es_client, embedding_model, questions)
+        config.knn_backend = "local"
+        local_results = bench("knn_local", elastic_util.query_knn, es_client, embedding_model, questions)
+
+        overlap = np.mean([len({d["id"] for d in a} & {d["id"] for d in b}) / len(a) for a, b in zip(elastic_results, local_results)])
+        _logger.info(f"knn elastic/local top-{config.elastic_result_num} overlap: {overlap:.3f}")
@@ -0,0 +1,120 @@
+import os, re, json
+from collections import Counter
+
+import numpy as np
+
+from log_util import get_logger
+
+_logger = get_logger(__name__)
+
+ARRAYS_FILE_NAME = "bm25.npz"
+VOCAB_FILE_NAME = "bm25_vocab.json"
+
+# close to the elasticsearch standard analyzer: lowercased unicode words, apostrophes and dots inside a word are kept
+_token_re = re.compile(r"\w+(?:['’.]\w+)*")
+
+def tokenize(text):
+    return _token_re.findall(text.lower())
+
+class BM25Index:
+    def __init__(self, vocab, offsets, postings_docs, postings_tfs, idf, doc_len, k1, b):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.postings_docs = postings_docs
+        self.postings_tfs = postings_tfs
+        self.idf = idf
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+
+        # per-document part of the bm25 denominator, independent of the query
+        avg_len = float(doc_len.mean()) if len(doc_len) else 1.0
+        self._norms = (k1 * (1.0 - b + b * doc_len / avg_len)).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts, k1, b):
+        log_prefix = "bm25_index_build"
+
+        vocab = {}
+        term_postings = []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[doc] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_id = vocab.setdefault(term, len(vocab))
+                if term_id == len(term_postings):
+                    term_postings.append([])
+                term_postings[term_id].append((doc, tf))
+
+        # postings of all terms in flat arrays, term t owns [offsets[t], offsets[t + 1])
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings) for postings in term_postings])
+        postings_docs = np.empty(offsets[-1], dtype=np.int32)
+        postings_tfs = np.empty(offsets[-1], dtype=np.float32)
+        for term_id, postings in enumerate(term_postings):
+            start = offsets[term_id]
+            postings_docs[start:start + len(postings)] = [doc for doc, _ in postings]
+            postings_tfs[start:start + len(postings)] = [tf for _, tf in postings]
+
+        doc_freq = np.diff(offsets).astype(np.float32)
+        idf = np.log1p((len(texts) - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+
+        _logger.info(f"{log_prefix}: success. docs#={len(texts)}, terms#={len(vocab)}, postings#={offsets[-1]}")
+        return cls(vocab, offsets, postings_docs, postings_tfs, idf, doc_len, k1, b)
+
+    @classmethod
+    def load(cls, index_dir, k1, b):
+        log_prefix = "bm25_index_load"
+
+        arrays = np.load(os.path.join(index_dir, ARRAYS_FILE_NAME))
+        with open(os.path.join(index_dir, VOCAB_FILE_NAME), "r") as f:
+            vocab = json.load(f)
+
+        index = cls(vocab, arrays["offsets"], arrays["postings_docs"], arrays["postings_tfs"], arrays["idf"], arrays["doc_len"], k1, b)
+        _logger.info(f"{log_prefix}: success. dir={index_dir}, docs#={len(index.doc_len)}, terms#={len(vocab)}")
+        return index
+
+    def save(self, index_dir):
+        log_prefix = "bm25_index_save"
+
+        os.makedirs(index_dir, exist_ok=True)
+        arrays_path = os.path.join(index_dir, ARRAYS_FILE_NAME)
+        vocab_path = os.path.join(index_dir, VOCAB_FILE_NAME)
+        with open(arrays_path + ".tmp", "wb") as f:
+            np.savez(f, offsets=self.offsets, postings_docs=self.postings_docs, postings_tfs=self.postings_tfs, idf=self.idf, doc_len=self.doc_len)
+        with open(vocab_path + ".tmp", "w") as f:
+            json.dump(self.vocab, f)
+        os.replace(arrays_path + ".tmp", arrays_path)
+        os.replace(vocab_path + ".tmp", vocab_path)
+
+        _logger.info(f"{log_prefix}: success. dir={index_dir}")
+
+    def scores(self, question):
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        # repeated query terms count once per occurrence, like the clauses of a match query
+        for term, query_tf in Counter(tokenize(question)).items():
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.postings_docs[start:end]
+            tfs = self.postings_tfs[start:end]
+            scores[docs] += query_tf * self.idf[term_id] * tfs / (tfs + self._norms[docs])
+        return scores
+
+    def search(self, question, k, rows=None):
+        scores = self.scores(question)
+        if rows is not None:
+            mask = np.zeros(len(scores), dtype=bool)
+            mask[rows] = True
+            scores[~mask] = 0.0
+        matched = np.flatnonzero(scores > 0)
+        k = min(k, len(matched))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        # ties broken by document order, as in lucene
+        order = np.lexsort((top, -scores[top]))
+        return top[order], scores[top[order]]
@@ -0,0 +1,94 @@
+import time, multiprocessing
+from itertools import chain, islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import semchunk
+import tiktoken
+
+from proj_config import config
+from log_util import get_logger
+
+_logger = get_logger(__name__)
+
+_chunker = None
+
+def _init_chunker(model_name, chunk_size):
+    global _chunker
+
+    _chunker = semchunk.chunkerify(tiktoken.encoding_for_model(model_name), chunk_size)
+
+def _get_chunker():
+    if _chunker is None:
+        _init_chunker(config.chunk_model_name, config.chunk_size)
+    return _chunker
+
+def chunk_segment(segment):
+    return _get_chunker()(segment)
+
+def _is_boundary(line):
+    # a blank line ends a paragraph, chunks never need to span it
+    return not line.strip()
+
+def split_segments(lines, segment_chars):
+    segment = []
+    segment_len = 0
+    for line in lines:
+        segment.append(line)
+        segment_len += len(line)
+        if segment_len >= segment_chars and _is_boundary(line):
+            yield "".join(segment)
+            segment = []
+            segment_len = 0
+    if segment:
+        yield "".join(segment)
+
+def read_segments(file_path, segment_chars):
+    with open(file_path, "r") as f:
+        yield from split_segments(f, segment_chars)
+
+def _create_pool(workers):
+    # spawn, not fork: callers run in threads (ingest pipeline, streamlit) and forking a threaded process can deadlock
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_chunker,
+        initargs=(config.chunk_model_name, config.chunk_size),
+    )
+
+def chunk_segments(segments, workers):
+    log_prefix = "chunk_segments"
+
+    start_time = time.time()
+    segments = list(segments)
+    if workers <= 1 or len(segments) <= 1:
+        chunks = [chunk for segment in segments for chunk in chunk_segment(segment)]
+    else:
+        # map keeps segment order, so chunk ids come out the same on every run and worker count
+        with _create_pool(min(workers, len(segments))) as executor:
+            chunks = [chunk for segment_chunks in executor.map(chunk_segment, segments) for chunk in segment_chunks]
+    elapsed = time.time() - start_time
+
+    _logger.info(f"{log_prefix}: success. segments#={len(segments)}, workers={workers}, chunks#={len(chunks)}, elapsed={elapsed:.2f}s, chunks/sec={len(chunks) / elapsed if elapsed > 0 else 0:.1f}")
+    return chunks
+
+def iter_chunk_segments(keyed_segments, workers):
+    # (key, segment) in, (key, chunks) out in input order; at most 2 * workers segments are held at once
+    keyed_segments = iter(keyed_segments)
+    head = list(islice(keyed_segments, 2))
+    # like chunk_segments, a single segment is chunked in-process, no pool is started for it
+    if workers <= 1 or len(head) <= 1:
+        for key, segment in chain(head, keyed_segments):
+            yield key, chunk_segment(segment)
+        return
+
+    with _create_pool(workers) as executor:
+        pending = deque()
+        for key, segment in chain(head, keyed_segments):
+            pending.append((key, executor.submit(chunk_segment, segment)))
+            if len(pending) >= 2 * workers:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
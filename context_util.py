@@ -0,0 +1,102 @@
+import re
+
+import tiktoken
+
+from proj_config import config
+from log_util import get_logger
+
+_logger = get_logger(__name__)
+
+# a passage cut to fewer tokens than this is dropped rather than sent as a fragment
+MIN_PASSAGE_TOKENS = 20
+
+_encoding = None
+
+def get_encoding():
+    global _encoding
+
+    # the tokenizer ingest.chunk sizes chunks with
+    if _encoding is None:
+        _encoding = tiktoken.encoding_for_model(config.chunk_model_name)
+    return _encoding
+
+def count_tokens(text):
+    return len(get_encoding().encode(text))
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def _position(doc):
+    try:
+        return int(doc["id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def format_passage(text):
+    return f"text: {text}\n\n"
+
+def concat_context(search_results):
+    return "".join(format_passage(doc["text"]) for doc in search_results)
+
+def merge_passages(search_results):
+    # unique chunks, remembering the best rank of each
+    docs = []
+    seen_texts = set()
+    for rank, doc in enumerate(search_results):
+        key = _normalize(doc["text"])
+        if key in seen_texts:
+            continue
+        seen_texts.add(key)
+        docs.append((_position(doc), rank, doc["text"]))
+
+    # chunks with consecutive ids were cut from one passage, glue them back in story order
+    passages = [] # [best rank, texts]
+    last_position = None
+    for position, rank, text in sorted(docs, key=lambda d: (d[0] is None, d[0] if d[0] is not None else d[1])):
+        if passages and position is not None and last_position is not None and position == last_position + 1:
+            passages[-1][0] = min(passages[-1][0], rank)
+            passages[-1][1].append(text)
+        else:
+            passages.append([rank, [text]])
+        last_position = position
+
+    # most relevant first, passages repeated inside a better-ranked one are dropped
+    merged = []
+    for _, texts in sorted(passages, key=lambda p: p[0]):
+        text = " ".join(texts)
+        key = _normalize(text)
+        if any(key in _normalize(kept) for kept in merged):
+            continue
+        merged.append(text)
+    return merged
+
+def assemble_context(search_results, token_budget=None):
+    log_prefix = "assemble_context"
+
+    if token_budget is None:
+        token_budget = config.context_token_budget
+
+    raw_context = concat_context(search_results)
+    raw_tokens = count_tokens(raw_context)
+    if not config.context_assembly:
+        return raw_context, {"context_tokens": raw_tokens, "context_tokens_saved": 0}
+
+    encoding = get_encoding()
+    parts = []
+    used_tokens = 0
+    passages = merge_passages(search_results)
+    for text in passages:
+        tokens = encoding.encode(format_passage(text))
+        remaining = token_budget - used_tokens
+        if len(tokens) > remaining:
+            # keep the head of the passage that crosses the budget, then stop
+            if remaining >= MIN_PASSAGE_TOKENS:
+                parts.append(encoding.decode(tokens[:remaining]).rstrip() + "\n\n")
+                used_tokens += remaining
+            break
+        parts.append(format_passage(text))
+        used_tokens += len(tokens)
+
+    stats = {"context_tokens": used_tokens, "context_tokens_saved": raw_tokens - used_tokens}
+    _logger.debug(f"{log_prefix}: chunks#={len(search_results)}, passages#={len(passages)}, used#={len(parts)}, tokens={used_tokens}/{token_budget}, saved={stats['context_tokens_saved']}")
+    return "".join(parts), stats
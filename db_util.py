@@ -1,11 +1,14 @@
-import os
+import os, time, queue, atexit, threading
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.extras
 
 from proj_config import config
 from log_util import get_logger
-from proj_util import check_service
+from proj_util import check_service, mark_unhealthy
 
 TZ = os.getenv("TZ", "America/Puerto_Rico")
 
@@ -19,6 +22,11 @@ _logger = get_logger(__name__)
 
 _tz = ZoneInfo(TZ)
 
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_last_used = {} # id(conn) -> last release time
+
 def create_connection():
     log_prefix = "create_db_connection"
 
@@ -26,19 +34,123 @@ def create_connection():
         _logger.error(f"{log_prefix}: failed!")
         return None
 
-    connection = psycopg2.connect(
-        host=POSTGRES_HOST,
-        port=POSTGRES_PORT,
-        database=POSTGRES_DB,
-        user=POSTGRES_USER,
-        password=POSTGRES_PASSWORD,
-    )
+    try:
+        connection = psycopg2.connect(
+            host=POSTGRES_HOST,
+            port=POSTGRES_PORT,
+            database=POSTGRES_DB,
+            user=POSTGRES_USER,
+            password=POSTGRES_PASSWORD,
+        )
+    except psycopg2.OperationalError:
+        # the next check_service probes again instead of trusting the cached result
+        mark_unhealthy(POSTGRES_HOST, POSTGRES_PORT)
+        raise
     return connection
 
+def _get_pool():
+    global _pool, _pool_slots
+    log_prefix = "create_db_pool"
+
+    with _pool_lock:
+        if _pool is None:
+            if not check_service(POSTGRES_HOST, POSTGRES_PORT):
+                _logger.error(f"{log_prefix}: failed!")
+                return None
+
+            try:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    config.db_pool_min_size,
+                    config.db_pool_max_size,
+                    host=POSTGRES_HOST,
+                    port=POSTGRES_PORT,
+                    database=POSTGRES_DB,
+                    user=POSTGRES_USER,
+                    password=POSTGRES_PASSWORD,
+                )
+            except psycopg2.OperationalError:
+                mark_unhealthy(POSTGRES_HOST, POSTGRES_PORT)
+                raise
+            # ThreadedConnectionPool raises when exhausted, callers wait for a free slot instead
+            _pool_slots = threading.BoundedSemaphore(config.db_pool_max_size)
+            _logger.info(f"{log_prefix}: success. min_size={config.db_pool_min_size}, max_size={config.db_pool_max_size}")
+        return _pool
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.time() - _last_used.get(id(conn), 0) < config.db_pool_health_check_interval:
+        return True
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_connection():
+    log_prefix = "get_connection"
+
+    pool = _get_pool()
+    if pool is None:
+        return None
+
+    if not _pool_slots.acquire(timeout=config.db_pool_acquire_timeout):
+        raise RuntimeError(f"{log_prefix}: failed! no free connection after {config.db_pool_acquire_timeout}s, max_size={config.db_pool_max_size}")
+    try:
+        # a broken connection is replaced, and the replacement is checked too
+        for attempt in range(config.db_pool_max_size + 1):
+            conn = pool.getconn()
+            if _is_healthy(conn):
+                return conn
+            _logger.warning(f"{log_prefix}: dropping broken connection. attempt={attempt + 1}")
+            _last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError(f"{log_prefix}: failed! no healthy connection after {config.db_pool_max_size + 1} attempts")
+    except Exception as e:
+        if isinstance(e, psycopg2.OperationalError):
+            mark_unhealthy(POSTGRES_HOST, POSTGRES_PORT)
+        _pool_slots.release()
+        raise
+
+def release_connection(conn):
+    if conn is None:
+        return
+
+    try:
+        if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except psycopg2.Error:
+        pass
+    finally:
+        if conn.closed:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.time()
+        # under the lock, close_pool cannot close the pool between the check and the put
+        with _pool_lock:
+            if _pool is None:
+                # the pool was closed (atexit) while this connection was checked out
+                conn.close()
+            else:
+                _pool.putconn(conn, close=bool(conn.closed))
+        _pool_slots.release()
+
+@atexit.register
+def close_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
 def init_db():
     log_prefix = "init_db"
 
-    conn = create_connection()
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute("DROP TABLE IF EXISTS keyvalues")
@@ -52,9 +164,15 @@ def init_db():
                     search_type TEXT NOT NULL,
                     answer TEXT NOT NULL,
                     response_time FLOAT NOT NULL,
+                    time_to_first_token FLOAT,
+                    tokens_per_second FLOAT,
+                    total_time FLOAT,
                     prompt_tokens INTEGER NOT NULL,
                     completion_tokens INTEGER NOT NULL,
                     total_tokens INTEGER NOT NULL,
+                    cached BOOLEAN NOT NULL DEFAULT FALSE,
+                    cache_tier TEXT,
+                    context_tokens_saved INTEGER,
                     timestamp TIMESTAMP WITH TIME ZONE NOT NULL
                 )
             """)
@@ -76,10 +194,29 @@ def init_db():
 
         _logger.info(f"{log_prefix}: success.")
     finally:
-        conn.close()
+        release_connection(conn)
+
+def migrate_db():
+    log_prefix = "migrate_db"
+
+    # columns added after the initial schema, for databases created by an older init_db
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS cached BOOLEAN NOT NULL DEFAULT FALSE")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS cache_tier TEXT")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS time_to_first_token FLOAT")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS tokens_per_second FLOAT")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS total_time FLOAT")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS context_tokens_saved INTEGER")
+        conn.commit()
+
+        _logger.info(f"{log_prefix}: success.")
+    finally:
+        release_connection(conn)
 
 def check_inited():
-    conn = create_connection()
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute("""
@@ -91,76 +228,205 @@ def check_inited():
             """)
             return cur.fetchone()[0]
     finally:
-        conn.close()
+        release_connection(conn)
 
-def save_conversation(conversation_id, question, search_type, answer_data, timestamp=None):
-    log_prefix = "save_conversation"
+CONVERSATION_INSERT = """
+    INSERT INTO conversations
+    (id, question, search_type, answer, response_time, time_to_first_token, tokens_per_second, total_time,
+    prompt_tokens, completion_tokens, total_tokens, cached, cache_tier, context_tokens_saved, timestamp)
+    VALUES %s
+"""
+FEEDBACK_INSERT = """
+    INSERT INTO feedback
+    (conversation_id, feedback, timestamp)
+    VALUES %s
+"""
 
-    if timestamp is None:
-        timestamp = datetime.now(_tz)
-
-    conn = create_connection()
+def insert_rows(conversation_rows, feedback_rows):
+    # conversations first, feedback references them
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO conversations 
-                (id, question, search_type, answer, response_time, prompt_tokens, completion_tokens, total_tokens, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    conversation_id,
-                    question,
-                    search_type,
-                    answer_data["answer"],
-                    answer_data["response_time"],
-                    answer_data["prompt_tokens"],
-                    answer_data["completion_tokens"],
-                    answer_data["total_tokens"],
-                    timestamp
-                ),
-            )
+            if conversation_rows:
+                psycopg2.extras.execute_values(cur, CONVERSATION_INSERT, conversation_rows)
+            if feedback_rows:
+                psycopg2.extras.execute_values(cur, FEEDBACK_INSERT, feedback_rows)
         conn.commit()
-
-        _logger.info(f"{log_prefix}: success.")
-    except Exception as e:
-        _logger.error(f"{log_prefix}: failed! e={str(e)}")
     finally:
-        conn.close()
+        release_connection(conn)
 
-def save_feedback(conversation_id, feedback, timestamp=None):
-    log_prefix = "save_feedback"
+class WriteBehindQueue:
+    def __init__(self, max_size, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
 
-    if timestamp is None:
-        timestamp = datetime.now(_tz)
+        self.flush_num = 0
+        self.row_num = 0
+        self.last_flush_time = 0.0
+
+        self._queue = queue.Queue(maxsize=max_size)
+        # conversation ids queued but not flushed yet, their feedback has to be written after them
+        self._pending_ids = set()
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, kind, row, timeout):
+        if kind == "conversation":
+            with self._pending_lock:
+                self._pending_ids.add(row[0])
+        try:
+            self._queue.put((kind, row), timeout=timeout)
+            return True
+        except queue.Full:
+            if kind == "conversation":
+                with self._pending_lock:
+                    self._pending_ids.discard(row[0])
+            return False
+
+    def is_pending(self, conversation_id):
+        with self._pending_lock:
+            return conversation_id in self._pending_ids
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        log_prefix = "write_behind_flush"
+
+        conversation_rows = [row for kind, row in batch if kind == "conversation"]
+        feedback_rows = [row for kind, row in batch if kind == "feedback"]
+
+        start_time = time.time()
+        try:
+            insert_rows(conversation_rows, feedback_rows)
+        except Exception as e:
+            _logger.error(f"{log_prefix}: batch failed, retrying row by row! e={str(e)}, rows#={len(batch)}")
+            for kind, row in batch:
+                try:
+                    insert_rows([row] if kind == "conversation" else [], [row] if kind == "feedback" else [])
+                except Exception as e:
+                    _logger.error(f"{log_prefix}: dropped row! kind={kind}, e={str(e)}")
+        with self._pending_lock:
+            self._pending_ids.difference_update(row[0] for row in conversation_rows)
+        self.last_flush_time = time.time() - start_time
+        self.flush_num += 1
+        self.row_num += len(batch)
+
+        _logger.info(f"{log_prefix}: success. conversations#={len(conversation_rows)}, feedback#={len(feedback_rows)}, flush_latency={self.last_flush_time * 1000:.1f}ms, queue_depth={self._queue.qsize()}")
+
+    def close(self):
+        log_prefix = "write_behind_close"
+
+        if not self._thread.is_alive():
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        _logger.info(f"{log_prefix}: success. flushes#={self.flush_num}, rows#={self.row_num}")
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "flushes": self.flush_num,
+            "rows": self.row_num,
+            "last_flush_latency": self.last_flush_time,
+        }
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    global _writer
+
+    if not config.db_write_behind:
+        return None
+
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriteBehindQueue(config.db_write_queue_size, config.db_write_batch_size, config.db_write_flush_interval)
+            # registered after close_pool, so it runs (and flushes) before the pool is closed
+            atexit.register(_writer.close)
+        return _writer
+
+def _save_row(log_prefix, kind, row):
+    writer = get_writer()
+    if writer is not None:
+        if writer.put(kind, row, config.db_write_enqueue_timeout):
+            _logger.debug(f"{log_prefix}: queued. queue_depth={writer.stats()['queue_depth']}")
+            return
+        if kind == "feedback" and writer.is_pending(row[0]):
+            # a synchronous insert would reach the table before its conversation, wait one more flush for a place
+            # behind it; a writer that cannot drain (database down) costs the feedback, not the request
+            if writer.put(kind, row, writer.flush_interval):
+                _logger.warning(f"{log_prefix}: write-behind queue full, queued behind its conversation.")
+            else:
+                _logger.error(f"{log_prefix}: failed! write-behind queue full, feedback dropped. conversation_id={row[0]}")
+            return
+        _logger.warning(f"{log_prefix}: write-behind queue full, writing synchronously.")
 
-    conn = create_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO feedback
-                (conversation_id, feedback, timestamp)
-                VALUES (%s, %s, %s)
-                """,
-                (
-                    conversation_id,
-                    feedback,
-                    timestamp
-                ),
-            )
-        conn.commit()
+        insert_rows([row] if kind == "conversation" else [], [row] if kind == "feedback" else [])
 
         _logger.info(f"{log_prefix}: success.")
     except Exception as e:
         _logger.error(f"{log_prefix}: failed! e={str(e)}")
-    finally:
-        conn.close()
+
+def save_conversation(conversation_id, question, search_type, answer_data, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(_tz)
+
+    row = (
+        conversation_id,
+        question,
+        search_type,
+        answer_data["answer"],
+        answer_data["response_time"],
+        answer_data.get("time_to_first_token"),
+        answer_data.get("tokens_per_second"),
+        answer_data.get("total_time"),
+        answer_data["prompt_tokens"],
+        answer_data["completion_tokens"],
+        answer_data["total_tokens"],
+        answer_data.get("cached", False),
+        answer_data.get("cache_tier"),
+        answer_data.get("context_tokens_saved"),
+        timestamp
+    )
+    _save_row("save_conversation", "conversation", row)
+
+def save_feedback(conversation_id, feedback, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(_tz)
+
+    row = (
+        conversation_id,
+        feedback,
+        timestamp
+    )
+    _save_row("save_feedback", "feedback", row)
 
 def save_keyvalue(key, value):
     log_prefix = "save_keyvalue"
 
-    conn = create_connection()
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -180,12 +446,12 @@ def save_keyvalue(key, value):
     except Exception as e:
         _logger.error(f"{log_prefix}: failed! e={str(e)}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_value_by_key(key):
     log_prefix = "get_value_by_key"
 
-    conn = create_connection()
+    conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -207,4 +473,4 @@ def get_value_by_key(key):
         return None
 
     finally:
-        conn.close()
+        release_connection(conn)
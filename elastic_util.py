@@ -1,16 +1,22 @@
-import os, json
+import os, json, math, time, uuid, threading, unicodedata
+from collections import OrderedDict
 from tqdm.auto import tqdm
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers, ConnectionError as ElasticConnectionError
 
 from proj_config import config
 from log_util import get_logger
-from proj_util import check_service
+from proj_util import check_service, mark_unhealthy
+import search_backend
 
 ELASTIC_HOST = "elasticsearch"
 ELASTIC_PORT = 9200
 
 _logger = get_logger(__name__)
 
+_query_vectors = OrderedDict()
+_query_vectors_lock = threading.Lock()
+_query_vectors_stats = {"hits": 0, "misses": 0, "encode_time": 0.0}
+
 def create_client():
     log_prefix = "create_client"
 
@@ -18,35 +24,218 @@ def create_client():
         _logger.error(f"{log_prefix}: failed!")
         return None
 
-    client = Elasticsearch(f"http://{ELASTIC_HOST}:{ELASTIC_PORT}")
-    _logger.info(f"{log_prefix}: success. info={json.dumps(client.info().raw, indent=2)}")
+    client = Elasticsearch(f"http://{ELASTIC_HOST}:{ELASTIC_PORT}", connections_per_node=config.elastic_connections_per_node)
+    try:
+        info = client.info()
+    except ElasticConnectionError:
+        # the port answered but the node did not, probe again next time
+        mark_unhealthy(ELASTIC_HOST, ELASTIC_PORT)
+        raise
+    _logger.info(f"{log_prefix}: success. info={json.dumps(info.raw, indent=2)}")
     return client
 
 def check_inited(es_client):
+    if "local" in (config.knn_backend, config.keyword_backend) and not search_backend.check_local_index():
+        return False
     return es_client.indices.exists(index=config.elastic_index_name)
 
-def index(es_client, properties, docs):
-    log_prefix = "index"
+def _bulk_actions(index_name, docs):
+    for doc in docs:
+        yield {
+            "_index": index_name,
+            "_id": str(doc["id"]),
+            "_source": doc,
+        }
+
+def _delete_actions(index_name, doc_ids):
+    for doc_id in doc_ids:
+        yield {
+            "_op_type": "delete",
+            "_index": index_name,
+            "_id": doc_id,
+        }
+
+def bulk_index(es_client, index_name, actions):
+    log_prefix = "bulk_index"
+
+    if config.elastic_bulk_workers > 1:
+        results = helpers.parallel_bulk(
+            es_client, actions,
+            thread_count=config.elastic_bulk_workers,
+            chunk_size=config.elastic_bulk_size,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+    else:
+        results = helpers.streaming_bulk(
+            es_client, actions,
+            chunk_size=config.elastic_bulk_size,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+
+    start_time = time.time()
+    success_num = 0
+    batch_errors = {}
+    for i, (ok, item) in enumerate(tqdm(results)):
+        if ok:
+            success_num += 1
+        else:
+            batch_errors.setdefault(i // config.elastic_bulk_size, []).append(item)
+    elapsed = time.time() - start_time
+
+    error_num = sum(len(errors) for errors in batch_errors.values())
+    for batch, errors in sorted(batch_errors.items()):
+        _logger.error(f"{log_prefix}: batch failed! index={index_name}, batch={batch}, errors#={len(errors)}, first_error={json.dumps(errors[0], default=str)}")
+
+    docs_per_sec = (success_num + error_num) / elapsed if elapsed > 0 else 0.0
+    _logger.info(f"{log_prefix}: done. index={index_name}, docs#={success_num}, errors#={error_num}, elapsed={elapsed:.2f}s, docs/sec={docs_per_sec:.1f}")
+    return success_num, error_num
+
+def check_alias(es_client):
+    return es_client.indices.exists_alias(name=config.elastic_index_name)
+
+def get_alias_indices(es_client):
+    if not check_alias(es_client):
+        return []
+    return list(es_client.indices.get_alias(name=config.elastic_index_name).body.keys())
+
+def swap_alias(es_client, new_index_name):
+    log_prefix = "swap_alias"
+
+    old_index_names = get_alias_indices(es_client)
+    actions = [{"add": {"index": new_index_name, "alias": config.elastic_index_name}}]
+    for old_index_name in old_index_names:
+        actions.append({"remove": {"index": old_index_name, "alias": config.elastic_index_name}})
+    if not old_index_names and es_client.indices.exists(index=config.elastic_index_name):
+        # legacy concrete index occupying the alias name, replaced in the same atomic request
+        actions.append({"remove_index": {"index": config.elastic_index_name}})
+    es_client.indices.update_aliases(actions=actions)
 
+    for old_index_name in old_index_names:
+        es_client.indices.delete(index=old_index_name, ignore_unavailable=True)
+
+    _logger.info(f"{log_prefix}: success. alias={config.elastic_index_name}, new_index={new_index_name}, old_indices={old_index_names}")
+
+def create_build_index(es_client, properties):
     index_settings = {
         "settings": {
             "number_of_shards": 1,
-            "number_of_replicas": 0
+            # no refresh and no replicas while loading, restored below
+            "number_of_replicas": 0,
+            "refresh_interval": "-1",
         },
         "mappings": {
             "properties": properties,
         }
     }
-    es_client.indices.delete(index=config.elastic_index_name, ignore_unavailable=True)
-    es_client.indices.create(index=config.elastic_index_name, body=index_settings)
-    for doc in tqdm(docs):
-        es_client.index(index=config.elastic_index_name, document=doc)
+    # build into a fresh versioned index, the alias keeps serving the old one until the swap;
+    # the random suffix keeps builds started in the same second apart
+    index_name = f"{config.elastic_index_name}_{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    es_client.indices.create(index=index_name, body=index_settings)
+    return index_name
+
+def restore_index_settings(es_client, index_name):
+    es_client.indices.put_settings(index=index_name, settings={
+        "number_of_replicas": config.elastic_replicas,
+        "refresh_interval": config.elastic_refresh_interval,
+    })
+    es_client.indices.refresh(index=index_name)
+
+def has_fields(es_client, fields):
+    mappings = es_client.indices.get_mapping(index=config.elastic_index_name).body
+    return all(all(field in mapping["mappings"].get("properties", {}) for field in fields) for mapping in mappings.values())
+
+def get_books(es_client):
+    # book -> title of the books in the index
+    response = es_client.search(index=config.elastic_index_name, body={
+        "size": 0,
+        "aggs": {"books": {"terms": {"field": "book", "size": 1000}, "aggs": {"title": {"terms": {"field": "title", "size": 1}}}}},
+    })
+    books = {}
+    for bucket in response["aggregations"]["books"]["buckets"]:
+        titles = bucket["title"]["buckets"]
+        books[bucket["key"]] = titles[0]["key"] if titles else bucket["key"]
+    return books
+
+def get_indexed_hashes(es_client):
+    hits = helpers.scan(
+        es_client,
+        index=config.elastic_index_name,
+        query={"_source": ["chunk_hash"]},
+    )
+    return {hit["_id"]: hit["_source"].get("chunk_hash") for hit in hits}
+
+def get_vectors(es_client, index_name, doc_ids):
+    # realtime get, so it also sees docs of an index that is not refreshed yet
+    response = es_client.mget(index=index_name, ids=doc_ids, source=["vector"])
+    return {doc["_id"]: doc["_source"]["vector"] for doc in response["docs"] if doc.get("found")}
+
+def update(es_client, docs, delete_ids, refresh=True):
+    log_prefix = "update"
+
+    index_name = config.elastic_index_name
+    upsert_num, upsert_error_num = bulk_index(es_client, index_name, _bulk_actions(index_name, docs))
+    delete_num, delete_error_num = bulk_index(es_client, index_name, _delete_actions(index_name, delete_ids))
+    if refresh:
+        es_client.indices.refresh(index=index_name)
+
+    if upsert_error_num or delete_error_num:
+        _logger.error(f"{log_prefix}: failed! upserts#={upsert_num}, deletes#={delete_num}, errors#={upsert_error_num + delete_error_num}")
+        return False
+
+    _logger.info(f"{log_prefix}: success. upserts#={upsert_num}, deletes#={delete_num}")
+    return True
+
+def normalize_question(question):
+    return " ".join(unicodedata.normalize("NFKC", question).split())
 
-    _logger.info(f"{log_prefix}: success.")
+def encode_query(embedding_model, question):
+    log_prefix = "encode_query"
 
-def query_text(es_client, embedding_model, question):
+    question = normalize_question(question)
+    # vectors differ slightly between embedding backends, as in the chunk embedding cache
+    key = (config.embedding_model_name, getattr(embedding_model, "backend_id", "torch"), question)
+    with _query_vectors_lock:
+        v = _query_vectors.get(key)
+        if v is not None:
+            _query_vectors.move_to_end(key)
+            _query_vectors_stats["hits"] += 1
+            hit_rate = _query_vectors_stats["hits"] / (_query_vectors_stats["hits"] + _query_vectors_stats["misses"])
+            _logger.debug(f"{log_prefix}: cache hit. hit_rate={hit_rate:.3f}")
+            return v
+
+    start_time = time.perf_counter()
+    v = embedding_model.encode(question)
+    encode_time = time.perf_counter() - start_time
+
+    with _query_vectors_lock:
+        _query_vectors[key] = v
+        _query_vectors.move_to_end(key)
+        while len(_query_vectors) > config.query_embedding_cache_size:
+            _query_vectors.popitem(last=False)
+        _query_vectors_stats["misses"] += 1
+        _query_vectors_stats["encode_time"] += encode_time
+        hit_rate = _query_vectors_stats["hits"] / (_query_vectors_stats["hits"] + _query_vectors_stats["misses"])
+        avg_encode_time = _query_vectors_stats["encode_time"] / _query_vectors_stats["misses"]
+
+    _logger.debug(f"{log_prefix}: cache miss. encode_time={encode_time * 1000:.1f}ms, avg_encode_time={avg_encode_time * 1000:.1f}ms, hit_rate={hit_rate:.3f}")
+    return v
+
+def get_query_cache_stats():
+    with _query_vectors_lock:
+        return dict(_query_vectors_stats, size=len(_query_vectors))
+
+def knn_params(size):
+    k = max(config.knn_k or size, size)
+    return k, max(config.knn_num_candidates, k)
+
+def book_filter(book):
+    return {"term": {"book": book}}
+
+def text_search_bodies(question, v, book=None, size=None):
     search_query = {
-        "size": config.elastic_result_num,
+        "size": size or config.elastic_result_num,
         "query": {
             "bool": {
                 "must": {
@@ -60,45 +249,63 @@ def query_text(es_client, embedding_model, question):
         },
         "_source": ["text", "id"]
     }
-    es_results = es_client.search(
-        index=config.elastic_index_name,
-        body=search_query
-    )
+    if book is not None:
+        search_query["query"]["bool"]["filter"] = book_filter(book)
+    return [search_query]
 
-    result_docs = []
-    for hit in es_results['hits']['hits']:
-        result_docs.append(hit['_source'])
-    return result_docs
+def knn_rescore(v, window_size):
+    # int8 neighbors re-ranked on the float vectors the index keeps, on the same scale as the knn score
+    return {
+        "window_size": window_size,
+        "query": {
+            "rescore_query": {
+                "script_score": {
+                    "query": {"match_all": {}},
+                    "script": {
+                        "source": "(cosineSimilarity(params.query_vector, 'vector') + 1.0) / 2.0",
+                        "params": {"query_vector": v}
+                    }
+                }
+            },
+            "query_weight": 0,
+            "rescore_query_weight": 1
+        }
+    }
 
-def query_knn(es_client, embedding_model, question):
-    v = embedding_model.encode(question)
+def knn_search_body(v, size, boost=None, book=None):
+    oversample = config.knn_rescore_oversample
+    k, num_candidates = knn_params(math.ceil(size * oversample) if oversample else size)
     knn = {
         "field": "vector",
         "query_vector": v,
-        "k": config.elastic_result_num,
-        "num_candidates": 10000
+        "k": k,
+        "num_candidates": num_candidates
     }
+    if boost is not None:
+        knn["boost"] = boost
+    if book is not None:
+        # applied while searching the graph, so k neighbors still come back
+        knn["filter"] = book_filter(book)
     search_query = {
         "knn": knn,
+        "size": size,
         "_source": ["text", "id"]
     }
-    es_results = es_client.search(
-        index=config.elastic_index_name,
-        body=search_query
-    )
+    if oversample:
+        search_query["rescore"] = knn_rescore(v, k)
+    return search_query
 
-    result_docs = []
-    for hit in es_results['hits']['hits']:
-        result_docs.append(hit['_source'])
-    return result_docs
+def knn_search_bodies(question, v, book=None, size=None):
+    return [knn_search_body(v, size or config.elastic_result_num, book=book)]
 
-def query_hybrid(es_client, embedding_model, question):
-    v = embedding_model.encode(question)
+def hybrid_search_bodies(question, v, book=None, size=None):
+    size = size or config.elastic_result_num
+    k, num_candidates = knn_params(size)
     knn_query = {
         "field": "vector",
         "query_vector": v,
-        "k": config.elastic_result_num,
-        "num_candidates": 10000,
+        "k": k,
+        "num_candidates": num_candidates,
         "boost": 0.5
     }
     keyword_query = {
@@ -113,34 +320,19 @@ def query_hybrid(es_client, embedding_model, question):
             }
         }
     }
+    if book is not None:
+        knn_query["filter"] = book_filter(book)
+        keyword_query["bool"]["filter"] = book_filter(book)
     search_query = {
         "knn": knn_query,
         "query": keyword_query,
-        "size": config.elastic_result_num,
+        "size": size,
         "_source": ["text", "id"]
     }
-    es_results = es_client.search(
-        index=config.elastic_index_name,
-        body=search_query
-    )
-    
-    result_docs = []
-    for hit in es_results['hits']['hits']:
-        result_docs.append(hit['_source'])
-    return result_docs
-
-def compute_rrf(rank, k=60):
-    return 1 / (k + rank)
+    return [search_query]
 
-def query_hybrid_rrf(es_client, embedding_model, question):
-    v = embedding_model.encode(question)
-    knn_query = {
-        "field": "vector",
-        "query_vector": v,
-        "k": config.elastic_result_num * 2,
-        "num_candidates": 10000,
-        "boost": 0.5
-    }
+def hybrid_rrf_search_bodies(question, v, book=None, size=None):
+    size = size or config.elastic_result_num
     keyword_query = {
         "bool": {
             "must": {
@@ -153,25 +345,150 @@ def query_hybrid_rrf(es_client, embedding_model, question):
             }
         }
     }
-    knn_results = es_client.search(
+    if book is not None:
+        keyword_query["bool"]["filter"] = book_filter(book)
+    return [
+        knn_search_body(v, size * 2, boost=0.5, book=book),
+        {"query": keyword_query, "size": size * 2, "_source": ["text", "id"]},
+    ]
+
+def hits_to_docs(responses):
+    result_docs = []
+    for hit in responses[0]['hits']['hits']:
+        result_docs.append(hit['_source'])
+    return result_docs
+
+def fuse_rrf_responses(responses, size=None):
+    return fuse_rrf(responses[0]['hits']['hits'], responses[1]['hits']['hits'], size)
+
+def msearch(es_client, bodies):
+    searches = []
+    for body in bodies:
+        searches.extend([{}, body])
+    responses = es_client.msearch(index=config.elastic_index_name, searches=searches)['responses']
+    for response in responses:
+        if "error" in response:
+            raise RuntimeError(f"msearch: failed! error={response['error']}")
+    return responses
+
+class ElasticBackend(search_backend.SearchBackend):
+    name = "elastic"
+
+    def __init__(self, es_client):
+        self.es_client = es_client
+
+    def knn(self, query_vectors, k, book=None):
+        bodies = [knn_search_body(v, k, book=book) for v in query_vectors]
+        return [response['hits']['hits'] for response in msearch(self.es_client, bodies)]
+
+    def keyword(self, questions, k, book=None):
+        bodies = [dict(text_search_bodies(question, None, book)[0], size=k) for question in questions]
+        return [response['hits']['hits'] for response in msearch(self.es_client, bodies)]
+
+def get_knn_backend(es_client):
+    if config.knn_backend == "local":
+        return search_backend.get_local_backend()
+    return ElasticBackend(es_client)
+
+def get_keyword_backend(es_client):
+    if config.keyword_backend == "local":
+        return search_backend.get_local_backend()
+    return ElasticBackend(es_client)
+
+def _search_legs(search_type):
+    if search_type == "text":
+        return [config.keyword_backend]
+    if search_type == "knn":
+        return [config.knn_backend]
+    return [config.knn_backend, config.keyword_backend]
+
+def uses_elastic_only(search_type):
+    # elasticsearch-only search types keep their single-request query paths
+    return all(backend == "elastic" for backend in _search_legs(search_type))
+
+def uses_elastic(search_type):
+    return any(backend == "elastic" for backend in _search_legs(search_type))
+
+def combine_hybrid(knn_hits, keyword_hits, size, boost=0.5):
+    # same scoring as the elasticsearch hybrid query: boosted knn score + boosted keyword score
+    scores = {}
+    sources = {}
+    for hits in (knn_hits, keyword_hits):
+        for hit in hits:
+            scores[hit['_id']] = scores.get(hit['_id'], 0.0) + boost * hit['_score']
+            sources[hit['_id']] = hit['_source']
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return [sources[doc_id] for doc_id, score in ranked[:size]]
+
+def search_batch(es_client, search_type, questions, vectors, book=None, size=None):
+    size = size or config.elastic_result_num
+    if search_type == "text":
+        hits_list = get_keyword_backend(es_client).keyword(questions, size, book)
+    elif search_type == "knn":
+        hits_list = get_knn_backend(es_client).knn(vectors, size, book)
+    elif search_type == "hybrid":
+        knn_hits_list = get_knn_backend(es_client).knn(vectors, size, book)
+        keyword_hits_list = get_keyword_backend(es_client).keyword(questions, size, book)
+        return [combine_hybrid(knn_hits, keyword_hits, size) for knn_hits, keyword_hits in zip(knn_hits_list, keyword_hits_list)]
+    elif search_type == "hybrid_rrf":
+        knn_hits_list = get_knn_backend(es_client).knn(vectors, size * 2, book)
+        keyword_hits_list = get_keyword_backend(es_client).keyword(questions, size * 2, book)
+        return [fuse_rrf(knn_hits, keyword_hits, size) for knn_hits, keyword_hits in zip(knn_hits_list, keyword_hits_list)]
+    else:
+        raise ValueError(f"search_batch: unknown search type! search_type={search_type}")
+    return [[hit['_source'] for hit in hits] for hits in hits_list]
+
+def query_text(es_client, embedding_model, question, book=None, size=None):
+    if not uses_elastic_only("text"):
+        return search_batch(es_client, "text", [question], None, book, size)[0]
+
+    es_results = es_client.search(
         index=config.elastic_index_name,
-        body={
-            "knn": knn_query, 
-            "size": config.elastic_result_num * 2,
-        }
-    )['hits']['hits']
-    keyword_results = es_client.search(
+        body=text_search_bodies(question, None, book, size)[0]
+    )
+    return hits_to_docs([es_results])
+
+def query_knn(es_client, embedding_model, question, book=None, size=None):
+    v = encode_query(embedding_model, question)
+    if not uses_elastic_only("knn"):
+        return search_batch(es_client, "knn", [question], [v], book, size)[0]
+
+    es_results = es_client.search(
         index=config.elastic_index_name,
-        body={
-            "query": keyword_query, 
-            "size": config.elastic_result_num * 2,
-        }
-    )['hits']['hits']
-    
+        body=knn_search_bodies(question, v, book, size)[0]
+    )
+    return hits_to_docs([es_results])
+
+def query_hybrid(es_client, embedding_model, question, book=None, size=None):
+    v = encode_query(embedding_model, question)
+    if not uses_elastic_only("hybrid"):
+        return search_batch(es_client, "hybrid", [question], [v], book, size)[0]
+
+    es_results = es_client.search(
+        index=config.elastic_index_name,
+        body=hybrid_search_bodies(question, v, book, size)[0]
+    )
+    return hits_to_docs([es_results])
+
+def compute_rrf(rank, k=60):
+    return 1 / (k + rank)
+
+def query_hybrid_rrf(es_client, embedding_model, question, book=None, size=None):
+    v = encode_query(embedding_model, question)
+    if not uses_elastic_only("hybrid_rrf"):
+        return search_batch(es_client, "hybrid_rrf", [question], [v], book, size)[0]
+
+    # both legs in one round trip, documents come from the hits
+    responses = msearch(es_client, hybrid_rrf_search_bodies(question, v, book, size))
+    return fuse_rrf_responses(responses, size)
+
+def fuse_rrf(knn_results, keyword_results, size=None):
     rrf_scores = {}
+    sources = {}
     for rank, hit in enumerate(knn_results):
         doc_id = hit['_id']
         rrf_scores[doc_id] = compute_rrf(rank + 1)
+        sources[doc_id] = hit['_source']
 
     for rank, hit in enumerate(keyword_results):
         doc_id = hit['_id']
@@ -179,11 +496,15 @@ def query_hybrid_rrf(es_client, embedding_model, question):
             rrf_scores[doc_id] += compute_rrf(rank + 1)
         else:
             rrf_scores[doc_id] = compute_rrf(rank + 1)
+            sources[doc_id] = hit['_source']
 
     reranked_docs = sorted(rrf_scores.items(), key=lambda x: x[1], reverse=True)
-    
-    final_results = []
-    for doc_id, score in reranked_docs[:config.elastic_result_num]:
-        doc = es_client.get(index=config.elastic_index_name, id=doc_id)
-        final_results.append(doc['_source'])
-    return final_results
+    return [sources[doc_id] for doc_id, score in reranked_docs[:size or config.elastic_result_num]]
+
+# search type -> (query function, msearch bodies builder, responses -> docs, needs query vector)
+SEARCH_TYPES = {
+    "text": (query_text, text_search_bodies, hits_to_docs, False),
+    "knn": (query_knn, knn_search_bodies, hits_to_docs, True),
+    "hybrid": (query_hybrid, hybrid_search_bodies, hits_to_docs, True),
+    "hybrid_rrf": (query_hybrid_rrf, hybrid_rrf_search_bodies, fuse_rrf_responses, True),
+}
@@ -0,0 +1,171 @@
+import os, json, hashlib
+
+import numpy as np
+
+from proj_config import config
+from log_util import get_logger
+
+_logger = get_logger(__name__)
+
+VECTORS_FILE_NAME = "vectors.npy"
+INDEX_FILE_NAME = "index.json"
+MIN_CAPACITY = 256
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, model_name, dim, normalize, max_mb):
+        self.dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.model_name = model_name
+        self.dim = dim
+        self.normalize = normalize
+        self.max_entries = max(1, int(max_mb * 1024 * 1024) // (dim * 4))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._vectors_path = os.path.join(self.dir, VECTORS_FILE_NAME)
+        self._index_path = os.path.join(self.dir, INDEX_FILE_NAME)
+        self._entries = {} # chunk hash -> [row, last_used]
+        self._free_rows = []
+        self._clock = 0
+        self._vectors = None
+        self._load()
+
+    def _load(self):
+        log_prefix = "embedding_cache_load"
+
+        os.makedirs(self.dir, exist_ok=True)
+        if os.path.exists(self._index_path) and os.path.exists(self._vectors_path):
+            try:
+                with open(self._index_path, "r") as f:
+                    index = json.load(f)
+                vectors = np.load(self._vectors_path, mmap_mode="r+")
+                if index["dim"] != self.dim or vectors.shape[1] != self.dim:
+                    raise ValueError(f"dim mismatch. cached={index['dim']}, expected={self.dim}")
+                if index["normalize"] != self.normalize:
+                    raise ValueError(f"normalize mismatch. cached={index['normalize']}, expected={self.normalize}")
+
+                self._vectors = vectors
+                self._entries = index["entries"]
+                self._clock = index["clock"]
+                used_rows = {row for row, _ in self._entries.values()}
+                self._free_rows = [row for row in range(vectors.shape[0]) if row not in used_rows]
+
+                _logger.info(f"{log_prefix}: success. dir={self.dir}, entries#={len(self._entries)}, capacity={vectors.shape[0]}")
+                return
+            except (OSError, ValueError, KeyError, json.JSONDecodeError) as e:
+                _logger.warning(f"{log_prefix}: discarding unreadable cache! e={str(e)}, dir={self.dir}")
+
+        self._entries = {}
+        self._clock = 0
+        capacity = min(MIN_CAPACITY, self.max_entries)
+        self._vectors = np.lib.format.open_memmap(self._vectors_path, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+        self._free_rows = list(range(capacity))
+
+    def _grow(self, needed):
+        capacity = self._vectors.shape[0]
+        new_capacity = min(max(capacity * 2, capacity + needed), self.max_entries)
+        if new_capacity <= capacity:
+            return
+
+        tmp_path = self._vectors_path + ".tmp"
+        vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(new_capacity, self.dim))
+        vectors[:capacity] = self._vectors
+        vectors.flush()
+        del self._vectors
+        os.replace(tmp_path, self._vectors_path)
+        self._vectors = vectors
+        self._free_rows.extend(range(capacity, new_capacity))
+
+    def _evict(self, needed):
+        # least recently used first
+        victims = sorted(self._entries.items(), key=lambda item: item[1][1])[:needed]
+        for key, _ in victims:
+            del self._entries[key]
+        # a row is only reused once the saved index no longer maps the evicted chunk to it,
+        # otherwise a crash before the next save would serve another chunk's vector as a hit
+        self.save()
+        self._free_rows.extend(row for _, (row, _) in victims)
+        self.evictions += len(victims)
+
+    def get_many(self, texts):
+        self._clock += 1
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        hit_mask = np.zeros(len(texts), dtype=bool)
+        for i, text in enumerate(texts):
+            entry = self._entries.get(chunk_hash(text))
+            if entry is None:
+                continue
+            vectors[i] = self._vectors[entry[0]]
+            entry[1] = self._clock
+            hit_mask[i] = True
+
+        hit_num = int(hit_mask.sum())
+        self.hits += hit_num
+        self.misses += len(texts) - hit_num
+        return vectors, hit_mask
+
+    def put_many(self, texts, vectors):
+        # the newest entries win if a single batch exceeds the cache size
+        texts = texts[-self.max_entries:]
+        vectors = vectors[-self.max_entries:]
+
+        new_keys = {chunk_hash(text) for text in texts} - self._entries.keys()
+        if len(new_keys) > len(self._free_rows):
+            self._grow(len(new_keys) - len(self._free_rows))
+        if len(new_keys) > len(self._free_rows):
+            self._evict(len(new_keys) - len(self._free_rows))
+
+        for text, vector in zip(texts, vectors):
+            key = chunk_hash(text)
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = [self._free_rows.pop(), self._clock]
+                self._entries[key] = entry
+            self._vectors[entry[0]] = vector
+            entry[1] = self._clock
+
+    def save(self):
+        log_prefix = "embedding_cache_save"
+
+        self._vectors.flush()
+        index = {
+            "model_name": self.model_name,
+            "dim": self.dim,
+            "normalize": self.normalize,
+            "clock": self._clock,
+            "entries": self._entries,
+        }
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self._index_path)
+
+        _logger.debug(f"{log_prefix}: success. dir={self.dir}, entries#={len(self._entries)}")
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+        }
+
+def create_embedding_cache(embedding_model):
+    if not config.embedding_cache_dir:
+        return None
+
+    # vectors differ slightly between backends, each gets its own cache (torch keeps the plain model name)
+    backend_id = getattr(embedding_model, "backend_id", "torch")
+    cache_name = config.embedding_model_name if backend_id == "torch" else f"{config.embedding_model_name}__{backend_id}"
+    return EmbeddingCache(
+        config.embedding_cache_dir,
+        cache_name,
+        embedding_model.get_sentence_embedding_dimension(),
+        config.embedding_normalize,
+        config.embedding_cache_max_mb,
+    )
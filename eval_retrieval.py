@@ -1,6 +1,7 @@
-import os
+import os, time
+from concurrent.futures import ThreadPoolExecutor
 
-from tqdm.auto import tqdm
+import numpy as np
 import pandas as pd
 
 from proj_config import config
@@ -10,29 +11,101 @@ import llm_util
 
 _logger = get_logger(__name__)
 
-def hit_rate(relevance_total):
-    cnt = 0
-    for line in relevance_total:
-        if True in line:
-            cnt = cnt + 1
-    return cnt / len(relevance_total)
-
-def mrr(relevance_total):
-    total_score = 0.0
-    for line in relevance_total:
-        for rank in range(len(line)):
-            if line[rank] == True:
-                total_score = total_score + 1 / (rank + 1)
-    return total_score / len(relevance_total)
-
-def eval(es_client, embedding_model, search_func):
-    relevance_total = []
-    for q in tqdm(ground_truth):
-        doc_id = q['document']
-        results = search_func(es_client, embedding_model, q['question'])
-        relevance = [d['id'] == doc_id for d in results]
-        relevance_total.append(relevance)
-    return hit_rate(relevance_total), mrr(relevance_total)
+def hit_rate(relevance):
+    return float(relevance.any(axis=1).mean())
+
+def mrr(relevance):
+    ranks = np.arange(1, relevance.shape[1] + 1)
+    return float((relevance / ranks).sum(axis=1).mean())
+
+def recall_at_k(relevance, k, relevant_num=1):
+    # every ground-truth question has exactly one relevant document
+    return float((relevance[:, :k].sum(axis=1) / relevant_num).mean())
+
+def relevance_matrix(results, doc_ids, k):
+    relevance = np.zeros((len(results), k), dtype=bool)
+    for i, (docs, doc_id) in enumerate(zip(results, doc_ids)):
+        for rank, d in enumerate(docs[:k]):
+            relevance[i, rank] = d['id'] == doc_id
+    return relevance
+
+def encode_questions(embedding_model, questions):
+    log_prefix = "encode_questions"
+
+    start_time = time.time()
+    vectors = embedding_model.encode(
+        [elastic_util.normalize_question(q) for q in questions],
+        batch_size=config.embedding_batch_size,
+        normalize_embeddings=config.embedding_normalize,
+        convert_to_numpy=True,
+        show_progress_bar=True,
+    )
+    elapsed = time.time() - start_time
+
+    _logger.info(f"{log_prefix}: success. questions#={len(questions)}, elapsed={elapsed:.2f}s, questions/sec={len(questions) / elapsed:.1f}")
+    return vectors
+
+def run_local_searches(es_client, search_type, questions, vectors):
+    results = []
+    latencies = []
+    for start in range(0, len(questions), config.eval_batch_size):
+        end = min(start + config.eval_batch_size, len(questions))
+        start_time = time.perf_counter()
+        results.extend(elastic_util.search_batch(es_client, search_type, questions[start:end], vectors[start:end]))
+        # one batched call, spread evenly over its questions
+        latencies.extend([(time.perf_counter() - start_time) * 1000 / (end - start)] * (end - start))
+    return results, np.array(latencies, dtype=np.float64)
+
+def run_searches(es_client, search_type, questions, vectors):
+    if not elastic_util.uses_elastic_only(search_type):
+        return run_local_searches(es_client, search_type, questions, vectors)
+
+    _, bodies_func, combine_func, needs_vector = elastic_util.SEARCH_TYPES[search_type]
+
+    def run_batch(start):
+        batch_bodies = []
+        for i in range(start, min(start + config.eval_batch_size, len(questions))):
+            batch_bodies.append(bodies_func(questions[i], vectors[i] if needs_vector else None))
+
+        flat_bodies = [body for bodies in batch_bodies for body in bodies]
+        start_time = time.perf_counter()
+        responses = elastic_util.msearch(es_client, flat_bodies)
+
+        batch_results = []
+        offset = 0
+        for bodies in batch_bodies:
+            question_responses = responses[offset:offset + len(bodies)]
+            offset += len(bodies)
+            batch_results.append(combine_func(question_responses))
+        # wall-clock of the msearch call and the fusion, spread evenly over its questions like run_local_searches
+        batch_latencies = [(time.perf_counter() - start_time) * 1000 / len(batch_bodies)] * len(batch_bodies)
+        return batch_results, batch_latencies
+
+    with ThreadPoolExecutor(max_workers=config.eval_concurrency) as executor:
+        batches = list(executor.map(run_batch, range(0, len(questions), config.eval_batch_size)))
+
+    results = [docs for batch_results, _ in batches for docs in batch_results]
+    latencies = np.array([latency for _, batch_latencies in batches for latency in batch_latencies], dtype=np.float64)
+    return results, latencies
+
+def eval(es_client, search_type, questions, vectors, doc_ids):
+    start_time = time.time()
+    results, latencies = run_searches(es_client, search_type, questions, vectors)
+    elapsed = time.time() - start_time
+
+    k = config.elastic_result_num
+    relevance = relevance_matrix(results, doc_ids, k)
+    return {
+        "search_type": search_type,
+        "hit_rate": hit_rate(relevance),
+        "mrr": mrr(relevance),
+        "recall@1": recall_at_k(relevance, 1),
+        "recall@3": recall_at_k(relevance, 3),
+        f"recall@{k}": recall_at_k(relevance, k),
+        "queries/sec": len(questions) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
 
 if __name__ == "__main__":
     from dotenv import load_dotenv
@@ -43,16 +116,25 @@ if __name__ == "__main__":
     elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
 
     df_ground_truth = pd.read_csv(config.ground_truth_file_path)
-    ground_truth = df_ground_truth.to_dict(orient='records')
+    questions = df_ground_truth['question'].tolist()
+    doc_ids = df_ground_truth['document'].tolist()
 
-    es_client = elastic_util.create_client()
+    es_client = None
+    if any(elastic_util.uses_elastic(search_type) for search_type in elastic_util.SEARCH_TYPES):
+        es_client = elastic_util.create_client()
     embedding_model = llm_util.create_embedding_model()
 
-    text_results = eval(es_client, embedding_model, elastic_util.query_text)
-    vector_results = eval(es_client, embedding_model, elastic_util.query_knn)
-    _logger.info(f"text: (hit_rate, mrr)={text_results}")
-    _logger.info(f"vector: (hit_rate, mrr)={vector_results}")
-    
-    # output:
+    query_funcs = {name for name in dir(elastic_util) if name.startswith("query_")}
+    covered_funcs = {query_func.__name__ for query_func, _, _, _ in elastic_util.SEARCH_TYPES.values()}
+    if query_funcs != covered_funcs:
+        _logger.warning(f"query functions without a search type: {sorted(query_funcs - covered_funcs)}")
+
+    vectors = encode_questions(embedding_model, questions)
+
+    metrics = [eval(es_client, search_type, questions, vectors, doc_ids) for search_type in elastic_util.SEARCH_TYPES]
+    df_metrics = pd.DataFrame(metrics).set_index("search_type")
+    _logger.info(f"retrieval evaluation:\n{df_metrics.round(3).to_string()}")
+
+    # output (hit_rate, mrr) before batching:
     # text: (hit_rate, mrr)=(0.7419753086419754, 0.6061522633744849)
     # vector: (hit_rate, mrr)=(0.7617283950617284, 0.6104526748971189)
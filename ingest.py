@@ -1,12 +1,13 @@
-import os
-from tqdm.auto import tqdm
-import semchunk
-import tiktoken
+import os, time, json, queue, hashlib, threading
+import numpy as np
 
 from proj_config import config
 from log_util import get_logger
 import elastic_util
 import llm_util
+import embedding_cache
+import chunk_util
+import search_backend
 
 _logger = get_logger(__name__)
 
@@ -22,64 +23,407 @@ def load_text():
 def chunk(content):
     log_prefix = "chunk"
 
-    chunker = semchunk.chunkerify(tiktoken.encoding_for_model(config.chunk_model_name), config.chunk_size)
-    chunks = chunker(content)
+    # paragraph-aligned segments, chunked in parallel once there is more than one
+    segments = chunk_util.split_segments(content.splitlines(keepends=True), config.chunk_segment_chars)
+    chunks = chunk_util.chunk_segments(segments, config.chunk_workers)
 
     _logger.info(f"{log_prefix}: success. chunks#={len(chunks)}, avg_chunk_len={int(sum([len(s) for s in chunks]) / len(chunks))}")
     return chunks
 
-def embed_chunks(chunks, embedding_model):
+def encode_chunks(chunks, embedding_model):
+    vectors = embedding_model.encode(
+        chunks,
+        batch_size=config.embedding_batch_size,
+        normalize_embeddings=config.embedding_normalize,
+        convert_to_numpy=True,
+        show_progress_bar=True,
+    )
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+def embed_chunks(chunks, embedding_model, cache=None, save=True):
     log_prefix = "embed_chunks"
 
-    docs = []
-    for i, chunk in enumerate(tqdm(chunks)):
-        doc = {
-            "text": chunk,
-            "vector": embedding_model.encode(chunk),
-            "id": i,
-        }
-        docs.append(doc)
+    start_time = time.time()
+    if cache is None:
+        vectors = encode_chunks(chunks, embedding_model)
+        cache_info = "cache=off"
+    else:
+        vectors, hit_mask = cache.get_many(chunks)
+        miss_idx = np.flatnonzero(~hit_mask)
+        if len(miss_idx):
+            miss_chunks = [chunks[i] for i in miss_idx]
+            miss_vectors = encode_chunks(miss_chunks, embedding_model)
+            vectors[miss_idx] = miss_vectors
+            cache.put_many(miss_chunks, miss_vectors)
+            if save:
+                cache.save()
+        cache_info = f"cache_hits={len(chunks) - len(miss_idx)}, cache_misses={len(miss_idx)}, cache_evictions={cache.evictions}"
+    elapsed = time.time() - start_time
 
-    _logger.info(f"{log_prefix}: success.")
-    return docs
+    _logger.info(f"{log_prefix}: success. shape={vectors.shape}, {cache_info}, elapsed={elapsed:.2f}s, chunks/sec={len(chunks) / elapsed if elapsed > 0 else 0.0:.1f}")
+    return vectors
 
-def index_docs(embedding_size, docs):
-    log_prefix = "index_docs"
+def list_books(data_dir=None):
+    log_prefix = "list_books"
 
-    es_client = elastic_util.create_client()
+    # data_file_path comes first, so on a fresh registry it is book 0 and keeps the ids ground-truth-data.csv refers to
+    paths = [config.data_file_path]
+    if data_dir is not None:
+        paths += [os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir)) if name.endswith(".txt")]
 
-    properties = {
-        "text": {"type": "text"},
-        "vector": {
-            "type": "dense_vector",
-            "dims": embedding_size,
-            "index": True,
-            "similarity": "cosine"
+    registry = load_book_registry()
+    books = []
+    for path in paths:
+        key = os.path.splitext(os.path.basename(path))[0]
+        if any(book["book"] == key for book in books):
+            continue
+        if key not in registry:
+            registry[key] = max(registry.values(), default=-1) + 1
+        books.append({
+            "book": key,
+            "title": key.replace("_", " "),
+            "path": path,
+            "offset": registry[key] * config.book_id_stride,
+        })
+    save_json(config.book_registry_path, registry)
+
+    _logger.info(f"{log_prefix}: success. books#={len(books)}, data_dir={data_dir}")
+    return books
+
+def load_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def load_book_registry():
+    return load_json(config.book_registry_path) or {}
+
+def gen_book_segments(books):
+    for book in books:
+        for segment in chunk_util.read_segments(book["path"], config.chunk_segment_chars):
+            yield book, segment
+
+def gen_chunk_batches(books, batch_size):
+    batch = []
+    positions = {}
+    for book, chunks in chunk_util.iter_chunk_segments(gen_book_segments(books), config.chunk_workers):
+        for text in chunks:
+            position = positions.get(book["book"], 0)
+            if position >= config.book_id_stride:
+                raise ValueError(f"gen_chunk_batches: more chunks than book_id_stride! book={book['book']}")
+            positions[book["book"]] = position + 1
+            batch.append({
+                "id": book["offset"] + position,
+                "book": book["book"],
+                "title": book["title"],
+                "position": position,
+                "text": text,
+            })
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def embed_batches(batches, embedding_model, cache, indexer):
+    try:
+        for batch in batches:
+            # chunks an interrupted run already indexed are read back from the index, chunks of earlier runs
+            # are embedding cache hits, so only new text is encoded
+            vectors = np.empty((len(batch), embedding_model.get_sentence_embedding_dimension()), dtype=np.float32)
+            indexed_vectors = indexer.indexed_vectors(batch)
+            for i, vector in indexed_vectors.items():
+                vectors[i] = vector
+            todo = [i for i in range(len(batch)) if i not in indexed_vectors]
+            if todo:
+                vectors[todo] = embed_chunks([batch[i]["text"] for i in todo], embedding_model, cache, save=False)
+            yield batch, vectors
+    finally:
+        # one save when the stage ends (or is stopped), rewriting the cache index per batch grows with the cache;
+        # evictions save on their own, so a crash in between only loses entries, never maps a chunk to a reused row
+        if cache is not None:
+            cache.save()
+
+_DONE = object()
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return _DONE
+
+def run_stage(items, stop):
+    # items are produced in their own thread, the bounded queue holds that thread back when the next stage falls behind
+    q = queue.Queue(maxsize=config.ingest_queue_size)
+    errors = []
+
+    def run():
+        try:
+            for item in items:
+                if not _put(q, item, stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.close()
+            _put(q, _DONE, stop)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while True:
+        item = _get(q, stop)
+        if item is _DONE:
+            break
+        yield item
+    if stop.is_set():
+        return
+    thread.join()
+    if errors:
+        raise errors[0]
+
+def gen_docs(records, vectors):
+    for record, vector in zip(records, vectors):
+        yield {
+            "text": record["text"],
+            "vector": vector,
+            "id": record["id"],
+            "chunk_hash": embedding_cache.chunk_hash(record["text"]),
+            "book": record["book"],
+            "title": record["title"],
+            "position": record["position"],
+        }
+
+def vector_mapping(embedding_size, m, ef_construction, index_type="hnsw"):
+    return {
+        "type": "dense_vector",
+        "dims": embedding_size,
+        "index": True,
+        "similarity": "cosine",
+        "index_options": {
+            "type": index_type,
+            "m": m,
+            "ef_construction": ef_construction,
         },
+    }
+
+def doc_properties(embedding_size):
+    return {
+        "text": {"type": "text"},
+        "vector": vector_mapping(embedding_size, config.hnsw_m, config.hnsw_ef_construction, config.vector_index_type),
         "id": {"type": "keyword"},
+        "chunk_hash": {"type": "keyword"},
+        "book": {"type": "keyword"},
+        "title": {"type": "keyword"},
+        "position": {"type": "integer"},
+    }
+
+def checkpoint_settings():
+    # a checkpoint only resumes an index built from the same chunks and vectors
+    return {
+        "chunk_size": config.chunk_size,
+        "chunk_model_name": config.chunk_model_name,
+        "embedding_model_name": config.embedding_model_name,
+        "embedding_backend": config.embedding_backend,
+        "book_id_stride": config.book_id_stride,
     }
-    elastic_util.index(es_client, properties, docs)
 
-    _logger.info(f"{log_prefix}: success.")
+def book_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-def ingest():
+class FullIndexer:
+    # bulk loads a new versioned index batch by batch, the alias is swapped to it once every batch is in
+    def __init__(self, es_client, embedding_size, books):
+        self.es_client = es_client
+        self.indexed_num = 0
+        self.skipped_num = 0
+        self.book_hashes = {book["book"]: book_hash(book["path"]) for book in books}
+        self.checkpoint = self._resume()
+        if self.checkpoint is None:
+            index_name = elastic_util.create_build_index(es_client, doc_properties(embedding_size))
+            self.checkpoint = {"index_name": index_name, "settings": checkpoint_settings(), "book_hashes": self.book_hashes, "indexed": {}}
+            save_json(config.ingest_checkpoint_path, self.checkpoint)
+        # positions indexed before this run, the embed stage reads them while write moves the checkpoint on
+        self.resumed = dict(self.checkpoint["indexed"])
+
+    def _resume(self):
+        log_prefix = "full_indexer_resume"
+
+        checkpoint = load_json(config.ingest_checkpoint_path)
+        if checkpoint is None:
+            return None
+
+        index_name = checkpoint["index_name"]
+        exists = self.es_client.indices.exists(index=index_name)
+        # chunks are skipped by position, which only holds while the indexed books are unchanged
+        book_hashes = checkpoint.get("book_hashes", {})
+        books_changed = any(book_hashes.get(book) != self.book_hashes.get(book) for book in checkpoint["indexed"])
+        if checkpoint["settings"] != checkpoint_settings() or books_changed or not exists or index_name in elastic_util.get_alias_indices(self.es_client):
+            if exists and index_name not in elastic_util.get_alias_indices(self.es_client):
+                self.es_client.indices.delete(index=index_name, ignore_unavailable=True)
+            _logger.info(f"{log_prefix}: checkpoint discarded. index={index_name}, books_changed={books_changed}")
+            return None
+
+        checkpoint["book_hashes"] = self.book_hashes
+
+        _logger.info(f"{log_prefix}: success. index={index_name}, indexed={checkpoint['indexed']}")
+        return checkpoint
+
+    def indexed_vectors(self, batch):
+        # i -> vector of the records an interrupted run already indexed
+        resumed = {str(record["id"]): i for i, record in enumerate(batch) if record["position"] < self.resumed.get(record["book"], 0)}
+        if not resumed:
+            return {}
+        vectors = elastic_util.get_vectors(self.es_client, self.checkpoint["index_name"], list(resumed))
+        return {resumed[doc_id]: vector for doc_id, vector in vectors.items()}
+
+    def write(self, batch, vectors):
+        log_prefix = "full_indexer_write"
+
+        index_name = self.checkpoint["index_name"]
+        indexed = self.checkpoint["indexed"]
+        # chunks of an interrupted run are already in the index
+        todo = [i for i, record in enumerate(batch) if record["position"] >= indexed.get(record["book"], 0)]
+        if todo:
+            docs = gen_docs([batch[i] for i in todo], vectors[todo])
+            success_num, error_num = elastic_util.bulk_index(self.es_client, index_name, elastic_util._bulk_actions(index_name, docs))
+            if error_num:
+                # the checkpoint still points before this batch, the next run retries it
+                _logger.error(f"{log_prefix}: failed! index={index_name}, docs#={success_num}, errors#={error_num}")
+                return False
+
+        for record in batch:
+            indexed[record["book"]] = max(indexed.get(record["book"], 0), record["position"] + 1)
+        save_json(config.ingest_checkpoint_path, self.checkpoint)
+        self.indexed_num += len(todo)
+        self.skipped_num += len(batch) - len(todo)
+        return True
+
+    def finish(self):
+        log_prefix = "full_indexer_finish"
+
+        index_name = self.checkpoint["index_name"]
+        elastic_util.restore_index_settings(self.es_client, index_name)
+        elastic_util.swap_alias(self.es_client, index_name)
+        os.remove(config.ingest_checkpoint_path)
+
+        _logger.info(f"{log_prefix}: success. index={index_name}, docs#={self.indexed_num}, resumed#={self.skipped_num}")
+        return True
+
+class IncrementalIndexer:
+    # upserts changed chunks batch by batch; the hash diff makes a rerun skip whatever an interrupted run already wrote
+    def __init__(self, es_client):
+        self.es_client = es_client
+        self.indexed_hashes = elastic_util.get_indexed_hashes(es_client)
+        self.seen_ids = set()
+        self.changed_num = 0
+
+    def indexed_vectors(self, batch):
+        # unchanged chunks are embedding cache hits
+        return {}
+
+    def write(self, batch, vectors):
+        changed = [i for i, record in enumerate(batch) if self.indexed_hashes.get(str(record["id"])) != embedding_cache.chunk_hash(record["text"])]
+        self.seen_ids.update(str(record["id"]) for record in batch)
+        if not changed:
+            return True
+
+        self.changed_num += len(changed)
+        return elastic_util.update(self.es_client, gen_docs([batch[i] for i in changed], vectors[changed]), [], refresh=False)
+
+    def finish(self):
+        log_prefix = "incremental_indexer_finish"
+
+        deleted_ids = [doc_id for doc_id in self.indexed_hashes if doc_id not in self.seen_ids]
+        _logger.info(f"{log_prefix}: diff. indexed#={len(self.indexed_hashes)}, chunks#={len(self.seen_ids)}, changed#={self.changed_num}, deleted#={len(deleted_ids)}")
+        return elastic_util.update(self.es_client, [], deleted_ids)
+
+def ingest(mode=None, es_client=None, embedding_model=None):
     log_prefix = "ingest"
 
-    content = load_text()
-    chunks = chunk(content)
-    embedding_model = llm_util.create_embedding_model()
-    docs = embed_chunks(chunks, embedding_model)
-    embedding_size = embedding_model.get_sentence_embedding_dimension()
-    index_docs(embedding_size, docs)
+    if mode is None:
+        mode = config.elastic_ingest_mode
+
+    books = list_books(config.data_dir)
+    if embedding_model is None:
+        embedding_model = llm_util.create_embedding_model()
+    cache = embedding_cache.create_embedding_cache(embedding_model)
+    if es_client is None:
+        es_client = elastic_util.create_client()
+
+    # incremental updates need an alias-managed index carrying chunk hashes and book fields, otherwise rebuild
+    if mode == "incremental" and elastic_util.check_alias(es_client) and elastic_util.has_fields(es_client, ["chunk_hash", "book"]):
+        indexer = IncrementalIndexer(es_client)
+    else:
+        mode = "full"
+        indexer = FullIndexer(es_client, embedding_model.get_sentence_embedding_dimension(), books)
+    local_writer = search_backend.LocalIndexWriter()
 
-    _logger.info(f"{log_prefix}: success.")
+    start_time = time.time()
+    chunk_num = 0
+    success = True
+    stop = threading.Event()
+    try:
+        # chunking, embedding and indexing overlap, each queue holds at most ingest_queue_size batches
+        batches = run_stage(gen_chunk_batches(books, config.ingest_batch_size), stop)
+        for batch, vectors in run_stage(embed_batches(batches, embedding_model, cache, indexer), stop):
+            if not indexer.write(batch, vectors):
+                success = False
+                break
+            local_writer.append(vectors, [{"id": record["id"], "text": record["text"], "book": record["book"]} for record in batch])
+            chunk_num += len(batch)
+        success = success and indexer.finish()
+    except BaseException:
+        local_writer.abort()
+        raise
+    finally:
+        stop.set()
+    elapsed = time.time() - start_time
+
+    if not success:
+        local_writer.abort()
+        _logger.error(f"{log_prefix}: failed! mode={mode}, chunks#={chunk_num}, elapsed={elapsed:.2f}s")
+        return
+    local_writer.close()
+
+    _logger.info(f"{log_prefix}: success. mode={mode}, books#={len(books)}, chunks#={chunk_num}, elapsed={elapsed:.2f}s, chunks/sec={chunk_num / elapsed if elapsed > 0 else 0.0:.1f}")
 
 if __name__ == "__main__":
+    import argparse
     from dotenv import load_dotenv
 
     load_dotenv()
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["full", "incremental"], default=None)
+    parser.add_argument("--data-dir", default=None, help="directory of *.txt books (default: config.data_dir)")
+    args = parser.parse_args()
+    if args.data_dir is not None:
+        config.data_dir = args.data_dir
+
     elastic_util.ELASTIC_HOST = "localhost"
     elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
 
-    ingest()
+    ingest(args.mode)
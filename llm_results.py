@@ -1,4 +1,5 @@
-import os, functools
+import os, json, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tqdm.auto import tqdm
 import pandas as pd
@@ -7,27 +8,88 @@ from proj_config import config
 from log_util import get_logger
 import elastic_util
 import llm_util
-from ingest import ingest
 
 _logger = get_logger(__name__)
 
-def get_llm_results(es_client, llm_client, embedding_model, samples, build_prompt_func):
+def retrieve(es_client, embedding_model, samples):
+    log_prefix = "retrieve"
+
+    start_time = time.time()
+    search_results = [elastic_util.query_knn(es_client, embedding_model, record["question"]) for record in tqdm(samples)]
+
+    _logger.info(f"{log_prefix}: success. questions#={len(samples)}, elapsed={time.time() - start_time:.2f}s")
+    return search_results
+
+def load_checkpoint(checkpoint_path):
+    answers = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of an interrupted write
+                    continue
+                answers[record["question"]] = record["answer"]
+    return answers
+
+def get_llm_results(llm_client, samples, search_results, build_prompt_func, checkpoint_path):
+    log_prefix = "get_llm_results"
+
+    answers = load_checkpoint(checkpoint_path)
+    pending = [i for i, record in enumerate(samples) if record["question"] not in answers]
+    _logger.info(f"{log_prefix}: resuming. done#={len(samples) - len(pending)}, pending#={len(pending)}, checkpoint={checkpoint_path}")
+
+    def generate(i):
+        prompt = build_prompt_func(samples[i]["question"], search_results[i])
+        answer, tokens, response_time = llm_util.llm(llm_client, prompt)
+        return answer, tokens
+
+    start_time = time.time()
+    completion_tokens = 0
+    failed_num = 0
+    with ThreadPoolExecutor(max_workers=config.llm_results_concurrency) as executor, open(checkpoint_path, "a") as f:
+        futures = {executor.submit(generate, i): i for i in pending}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            question = samples[futures[future]]["question"]
+            try:
+                answer, tokens = future.result()
+            except Exception as e:
+                failed_num += 1
+                _logger.error(f"{log_prefix}: generation failed! e={str(e)}, question={question}")
+                continue
+
+            answers[question] = answer
+            completion_tokens += tokens["completion_tokens"]
+            f.write(json.dumps({"question": question, "answer": answer}) + "\n")
+            f.flush()
+    elapsed = time.time() - start_time
+
+    done_num = len(pending) - failed_num
+    if elapsed > 0 and done_num:
+        _logger.info(f"{log_prefix}: throughput. answers#={done_num}, elapsed={elapsed:.2f}s, answers/min={done_num / elapsed * 60:.2f}, completion_tokens/sec={completion_tokens / elapsed:.1f}")
+    if failed_num:
+        _logger.error(f"{log_prefix}: incomplete! failed#={failed_num}, rerun to resume from {checkpoint_path}")
+        return None
+
     results = []
-    for record in tqdm(samples):
-        answer_data = llm_util.rag(
-            search_func=functools.partial(elastic_util.query_knn, es_client, embedding_model),
-            llm_func=functools.partial(llm_util.llm, llm_client),
-            build_prompt_func=build_prompt_func,
-            query=record["question"]
-        )
-        result = {
+    for record in samples:
+        results.append({
             "question": record["question"],
-            "answer": answer_data["answer"],
+            "answer": answers[record["question"]],
             "document": record["document"],
-        }
-        results.append(result)
+        })
     return pd.DataFrame(results, columns=["question", "answer", "document"])
 
+def run(llm_client, samples, search_results, build_prompt_func, output_file_path):
+    checkpoint_path = f"{output_file_path}.checkpoint.jsonl"
+    df_results = get_llm_results(llm_client, samples, search_results, build_prompt_func, checkpoint_path)
+    if df_results is None:
+        return
+
+    df_results.to_csv(output_file_path, index=False)
+    os.remove(checkpoint_path)
+
 if __name__ == "__main__":
     from dotenv import load_dotenv
 
@@ -36,7 +98,7 @@ if __name__ == "__main__":
     elastic_util.ELASTIC_HOST = "localhost"
     elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
     llm_util.OLLAMA_HOST = "localhost"
-    llm_util.OLLAMA__PORT = int(os.getenv("OLLAMA_LOCAL_PORT", 8501))
+    llm_util.OLLAMA_PORT = int(os.getenv("OLLAMA_LOCAL_PORT", 11434))
 
     es_client = elastic_util.create_client()
     llm_client = llm_util.create_client()
@@ -48,14 +110,16 @@ if __name__ == "__main__":
     df_sample = df_questions.sample(n=config.llm_results_num, random_state=1)
     samples = df_sample.to_dict(orient='records')
 
+    # both prompts are built from the same retrieval results
+    _logger.info(f"retrieving context...")
+    search_results = retrieve(es_client, embedding_model, samples)
+
     _logger.info(f"getting llm results for prompt...")
-    df_results_prompt = get_llm_results(es_client, llm_client, embedding_model, samples, llm_util.build_prompt)
-    df_results_prompt.to_csv(config.llm_results_prompt_file_path, index=False)
+    run(llm_client, samples, search_results, llm_util.build_prompt, config.llm_results_prompt_file_path)
 
     _logger.info(f"getting llm results for prompt2...")
-    df_results_prompt2 = get_llm_results(es_client, llm_client, embedding_model, samples, llm_util.build_prompt2)
-    df_results_prompt2.to_csv(config.llm_results_prompt2_file_path, index=False)
-    
-    # output:
+    run(llm_client, samples, search_results, llm_util.build_prompt2, config.llm_results_prompt2_file_path)
+
+    # output (sequential, before the concurrent runner):
     # getting llm results for prompt... elapsed: 20:54
     # getting llm results for prompt2... elapsed: 22:59
@@ -1,25 +1,134 @@
-import time, requests
+import time, json, threading, requests
 
+import httpx
 from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient, APIConnectionError
 
 from proj_config import config
 from log_util import get_logger
-from proj_util import check_service
+from proj_util import check_service, mark_unhealthy
+import elastic_util
+import context_util
+import embedding_cache
 
 OLLAMA_HOST = "ollama"
 OLLAMA_PORT = 11434
 
 _logger = get_logger(__name__)
 
-def create_embedding_model():
+_model_status = {"state": "unknown", "completed": None, "total": None}
+_model_thread = None
+_model_thread_lock = threading.Lock()
+
+def create_embedding_model(device=None, backend=None):
     log_prefix = "create_embedding_model"
 
-    embedding_model = SentenceTransformer(config.embedding_model_name)
+    backend = backend or config.embedding_backend
+    if backend == "onnx":
+        # optional dependency, only imported when selected
+        import onnx_embedding
+        embedding_model = onnx_embedding.create_onnx_embedding_model(
+            config.embedding_model_name,
+            config.embedding_onnx_dir,
+            config.embedding_onnx_quantize,
+            config.embedding_onnx_threads,
+        )
+    else:
+        embedding_model = SentenceTransformer(config.embedding_model_name, device=device)
     
-    _logger.info(f"{log_prefix}: success. embedding_size={embedding_model.get_sentence_embedding_dimension()}")
+    _logger.info(f"{log_prefix}: success. backend={backend}, embedding_size={embedding_model.get_sentence_embedding_dimension()}")
     return embedding_model
 
+def get_ollama_url():
+    return f"http://{OLLAMA_HOST}:{OLLAMA_PORT}"
+
+def check_model(ollama_url):
+    # an untagged name is pulled as :latest
+    names = {config.llm_model_name, f"{config.llm_model_name}:latest"}
+    response = requests.get(f"{ollama_url}/api/tags", timeout=config.chk_serv_timeout)
+    response.raise_for_status()
+    return any(model["name"] in names for model in response.json().get("models", []))
+
+def pull_model(ollama_url):
+    log_prefix = "pull_model"
+
+    start_time = time.time()
+    last_log_time = 0
+    with requests.post(f"{ollama_url}/api/pull", json={"name": config.llm_model_name, "stream": True}, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            progress = json.loads(line)
+            if "error" in progress:
+                raise RuntimeError(f"{log_prefix}: failed! error={progress['error']}")
+            _model_status.update(state="pulling", completed=progress.get("completed"), total=progress.get("total"))
+            if time.time() - last_log_time >= 5:
+                last_log_time = time.time()
+                _logger.info(f"{log_prefix}: {progress.get('status')}. completed={progress.get('completed')}, total={progress.get('total')}")
+
+    _logger.info(f"{log_prefix}: success. model={config.llm_model_name}, elapsed={time.time() - start_time:.2f}s")
+
+def warm_up_model(ollama_url, keep_alive=None):
+    log_prefix = "warm_up_model"
+
+    if keep_alive is None:
+        keep_alive = config.llm_keep_alive
+    # a generate request without a prompt only loads the model
+    start_time = time.time()
+    response = requests.post(f"{ollama_url}/api/generate", json={
+        "model": config.llm_model_name,
+        "keep_alive": keep_alive,
+    })
+    response.raise_for_status()
+    elapsed = time.time() - start_time
+
+    _logger.info(f"{log_prefix}: success. model={config.llm_model_name}, keep_alive={keep_alive}, elapsed={elapsed:.2f}s")
+    return elapsed
+
+def _prepare_model(ollama_url):
+    log_prefix = "prepare_model"
+
+    try:
+        _model_status.update(state="checking")
+        if not check_model(ollama_url):
+            _model_status.update(state="pulling")
+            pull_model(ollama_url)
+        if config.llm_warm_up:
+            _model_status.update(state="loading")
+            warm_up_model(ollama_url)
+        _model_status.update(state="ready")
+    except (requests.RequestException, RuntimeError, ValueError) as e:
+        if isinstance(e, requests.ConnectionError):
+            mark_unhealthy(OLLAMA_HOST, OLLAMA_PORT)
+        _model_status.update(state="failed")
+        _logger.error(f"{log_prefix}: failed! e={str(e)}")
+
+def prepare_model():
+    global _model_thread
+
+    # in the background, so clients are usable while the model is pulled or loaded
+    with _model_thread_lock:
+        if _model_thread is None or (not _model_thread.is_alive() and _model_status["state"] == "failed"):
+            _model_thread = threading.Thread(target=_prepare_model, args=(get_ollama_url(),), name="prepare_model", daemon=True)
+            _model_thread.start()
+
+def wait_model(timeout=None):
+    # a failed pull or warm-up is retried here, the app caches its client and never calls prepare_model again
+    if _model_status["state"] == "failed":
+        prepare_model()
+    thread = _model_thread
+    if thread is not None:
+        thread.join(timeout)
+    return _model_status["state"] == "ready"
+
+def _require_model():
+    if not wait_model():
+        raise RuntimeError(f"model {config.llm_model_name} is not ready! state={_model_status['state']}, see the prepare_model logs")
+
+def get_model_status():
+    return dict(_model_status)
+
 def create_client():
     log_prefix = "create_client"
 
@@ -27,58 +136,82 @@ def create_client():
         _logger.error(f"{log_prefix}: failed!")
         return None
     
-    ollama_url = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}"
+    ollama_url = get_ollama_url()
+    prepare_model()
 
-    response = requests.post(f'{ollama_url}/api/pull', json={
-        "name": config.llm_model_name,
-        "stream": False
-    })
-    _logger.debug(f"{log_prefix}: pull model. response={response}")
-
-    return OpenAI(api_key="ollama", base_url=f"{ollama_url}/v1/")
+    # one keep-alive pool, shared by every caller of this client
+    http_client = DefaultHttpxClient(limits=httpx.Limits(
+        max_connections=config.llm_http_pool_size,
+        max_keepalive_connections=config.llm_http_pool_size,
+        keepalive_expiry=config.llm_http_keepalive_expiry,
+    ))
+    return OpenAI(api_key="ollama", base_url=f"{ollama_url}/v1/", http_client=http_client)
 
-def build_prompt(query, search_results):
-    prompt_template = """
+# static instructions go first as the system message, byte-identical across requests,
+# so the server can reuse the cached prefix and only prefill the context and question
+SYSTEM_PROMPT = """
 You are an expert detective analyzing the details of the story "The Adventure of the Speckled Band." Answer the QUESTION using only the relevant information provided in the CONTEXT from the story.
 
 Make sure to stay true to the facts in the CONTEXT when answering the QUESTION. Avoid adding any outside knowledge or assumptions.
+""".strip()
 
-QUESTION: {question}
+SYSTEM_PROMPT2 = """
+You are a meticulous detective focused on delivering fact-based answers strictly derived from the CONTEXT provided from "The Adventure of the Speckled Band." Answer the QUESTION by citing specific lines or details directly from the CONTEXT. Refrain from adding any interpretation or external knowledge.
+""".strip()
 
+USER_PROMPT_TEMPLATE = """
 CONTEXT:
 {context}
+
+QUESTION: {question}
 """.strip()
 
-    context = ""
-    for doc in search_results:
-        context = context + f"text: {doc['text']}\n\n"
+def _build_messages(system_prompt, query, search_results, stats):
+    context, context_stats = context_util.assemble_context(search_results)
+    if stats is not None:
+        stats.update(context_stats)
 
-    prompt = prompt_template.format(question=query, context=context).strip()
-    return prompt
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": USER_PROMPT_TEMPLATE.format(context=context.strip(), question=query)},
+    ]
 
-def build_prompt2(query, search_results):
-    prompt_template = """
-You are a meticulous detective focused on delivering fact-based answers strictly derived from the CONTEXT provided from "The Adventure of the Speckled Band." Answer the QUESTION by citing specific lines or details directly from the CONTEXT. Refrain from adding any interpretation or external knowledge.
+def build_prompt(query, search_results, stats=None):
+    return _build_messages(SYSTEM_PROMPT, query, search_results, stats)
 
-QUESTION: {question}
+def build_prompt2(query, search_results, stats=None):
+    return _build_messages(SYSTEM_PROMPT2, query, search_results, stats)
 
-CONTEXT:
-{context}
-""".strip()
+def to_messages(prompt):
+    # plain strings are still accepted as a single user message
+    if isinstance(prompt, str):
+        return [{"role": "user", "content": prompt}]
+    return prompt
 
-    context = ""
-    for doc in search_results:
-        context = context + f"text: {doc['text']}\n\n"
+def generation_kwargs(request_type):
+    options = config.llm_request_options[request_type]
+    kwargs = {}
+    if options.get("num_predict") is not None:
+        kwargs["max_tokens"] = options["num_predict"]
+    return kwargs
 
-    prompt = prompt_template.format(question=query, context=context).strip()
-    return prompt
+def _chat_completion(llm_client, prompt, request_type, **kwargs):
+    try:
+        return llm_client.chat.completions.create(
+            model=config.llm_model_name,
+            messages=to_messages(prompt),
+            **generation_kwargs(request_type),
+            **kwargs
+        )
+    except APIConnectionError:
+        # the next check_service probes again instead of trusting the cached result
+        mark_unhealthy(OLLAMA_HOST, OLLAMA_PORT)
+        raise
 
-def llm(llm_client, prompt):
+def llm(llm_client, prompt, request_type="eval"):
+    _require_model()
     start_time = time.time()
-    response = llm_client.chat.completions.create(
-        model=config.llm_model_name,
-        messages=[{"role": "user", "content": prompt}]
-    )
+    response = _chat_completion(llm_client, prompt, request_type)
     end_time = time.time()
     response_time = end_time - start_time
     tokens = {
@@ -88,14 +221,144 @@ def llm(llm_client, prompt):
     }
     return response.choices[0].message.content, tokens, response_time
 
-def rag(search_func, llm_func, build_prompt_func, query):
+def llm_stream(llm_client, prompt, stats, request_type="chat"):
+    _require_model()
+    start_time = time.time()
+    response = _chat_completion(llm_client, prompt, request_type, stream=True, stream_options={"include_usage": True})
+
+    first_token_time = None
+    chunk_num = 0
+    usage = None
+    for chunk in response:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if first_token_time is None:
+                first_token_time = time.time()
+            chunk_num += 1
+            yield delta
+    end_time = time.time()
+
+    if first_token_time is None:
+        first_token_time = end_time
+    # servers without usage in stream responses send roughly one token per chunk
+    completion_tokens = usage.completion_tokens if usage is not None else chunk_num
+    prompt_tokens = usage.prompt_tokens if usage is not None else 0
+    generation_time = end_time - first_token_time
+    stats.update({
+        "response_time": end_time - start_time,
+        "time_to_first_token": first_token_time - start_time,
+        "tokens_per_second": completion_tokens / generation_time if generation_time > 0 else None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    })
+
+def _cached_answer_data(answer_data, cache_tier, start_time):
+    elapsed = time.time() - start_time
+    return dict(
+        answer_data,
+        response_time=elapsed,
+        time_to_first_token=None,
+        tokens_per_second=None,
+        total_time=elapsed,
+        prompt_tokens=0,
+        completion_tokens=0,
+        total_tokens=0,
+        cached=True,
+        cache_tier=cache_tier,
+        context_tokens_saved=None,
+    )
+
+def _rag_lookup(search_func, build_prompt_func, query, search_type, embedding_model, answer_cache, book=None, rerank_func=None):
+    log_prefix = "rag"
+
     search_results = search_func(query)
-    prompt = build_prompt_func(query, search_results)
+    if rerank_func is not None:
+        search_results = rerank_func(query, search_results)
+    if answer_cache is None:
+        return search_results, None, None
+
+    # an answer from one book's passages is no answer for another book
+    scope = (search_type, book, build_prompt_func.__name__, config.llm_model_name)
+    # ids are positions in a book, the text hash makes a re-ingested chunk a different passage
+    doc_keys = [f"{doc['id']}:{embedding_cache.chunk_hash(doc['text'])}" for doc in search_results]
+    cache_key = answer_cache.make_key(query, scope, doc_keys)
+    cached = answer_cache.get_exact(cache_key)
+    if cached is not None:
+        _logger.info(f"{log_prefix}: served from cache. tier=exact, stats={answer_cache.stats()}")
+        return search_results, None, (cached, "exact")
+
+    # the query vector was already computed (and cached) by the search function;
+    # a similar question only reuses an answer built from the same passages, so a re-ingest invalidates it too
+    query_vector = elastic_util.encode_query(embedding_model, query) if embedding_model is not None else None
+    semantic_scope = scope + (tuple(sorted(doc_keys)),)
+    cached = answer_cache.get_semantic(semantic_scope, query_vector)
+    if cached is not None:
+        _logger.info(f"{log_prefix}: served from cache. tier=semantic, stats={answer_cache.stats()}")
+        return search_results, None, (cached, "semantic")
+
+    return search_results, (cache_key, semantic_scope, query_vector), None
+
+def rag(search_func, llm_func, build_prompt_func, query, search_type=None, embedding_model=None, answer_cache=None, book=None, rerank_func=None):
+    start_time = time.time()
+    search_results, cache_entry, cached = _rag_lookup(search_func, build_prompt_func, query, search_type, embedding_model, answer_cache, book, rerank_func)
+    if cached is not None:
+        return _cached_answer_data(*cached, start_time)
+
+    prompt_stats = {}
+    prompt = build_prompt_func(query, search_results, prompt_stats)
     answer, tokens, response_time = llm_func(prompt)
-    return {
+    answer_data = {
         "answer": answer,
         "response_time": response_time,
+        "time_to_first_token": None,
+        "tokens_per_second": None,
+        "total_time": time.time() - start_time,
         "prompt_tokens": tokens["prompt_tokens"],
         "completion_tokens": tokens["completion_tokens"],
-        "total_tokens": tokens["total_tokens"]
+        "total_tokens": tokens["total_tokens"],
+        "cached": False,
+        "cache_tier": None,
+        "context_tokens_saved": prompt_stats.get("context_tokens_saved"),
     }
+
+    if cache_entry is not None:
+        answer_cache.put(*cache_entry, answer_data)
+
+    return answer_data
+
+def rag_stream(search_func, llm_stream_func, build_prompt_func, query, answer_data, search_type=None, embedding_model=None, answer_cache=None, book=None, rerank_func=None):
+    log_prefix = "rag_stream"
+
+    # yields answer tokens, answer_data is filled in once the stream is exhausted
+    start_time = time.time()
+    search_results, cache_entry, cached = _rag_lookup(search_func, build_prompt_func, query, search_type, embedding_model, answer_cache, book, rerank_func)
+    if cached is not None:
+        answer_data.update(_cached_answer_data(*cached, start_time))
+        yield answer_data["answer"]
+        return
+
+    prompt_stats = {}
+    prompt = build_prompt_func(query, search_results, prompt_stats)
+    stats = {}
+    tokens = []
+    for token in llm_stream_func(prompt, stats):
+        tokens.append(token)
+        yield token
+
+    answer_data.update(stats)
+    answer_data.update({
+        "answer": "".join(tokens),
+        "total_time": time.time() - start_time,
+        "cached": False,
+        "cache_tier": None,
+        "context_tokens_saved": prompt_stats.get("context_tokens_saved"),
+    })
+    _logger.info(f"{log_prefix}: done. time_to_first_token={answer_data['time_to_first_token']:.2f}s, tokens_per_second={answer_data['tokens_per_second'] or 0:.1f}, response_time={answer_data['response_time']:.2f}s, total_time={answer_data['total_time']:.2f}s")
+
+    if cache_entry is not None:
+        answer_cache.put(*cache_entry, dict(answer_data))
@@ -0,0 +1,147 @@
+import os, json, time
+
+import numpy as np
+import onnxruntime as ort
+from tqdm.auto import tqdm
+from transformers import AutoTokenizer
+
+from log_util import get_logger
+
+_logger = get_logger(__name__)
+
+MODEL_FILE_NAME = "model.onnx"
+QUANTIZED_MODEL_FILE_NAME = "model.int8.onnx"
+META_FILE_NAME = "meta.json"
+
+def get_model_dir(onnx_dir, model_name):
+    return os.path.join(onnx_dir, model_name.replace("/", "__"))
+
+def export(model_name, model_dir):
+    # torch is only needed for this one-off conversion
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Pooling, Normalize
+
+    log_prefix = "onnx_export"
+
+    start_time = time.time()
+    st_model = SentenceTransformer(model_name, device="cpu")
+    pooling = next(module for module in st_model if isinstance(module, Pooling))
+    if pooling.get_pooling_mode_str() != "mean":
+        raise ValueError(f"{log_prefix}: unsupported pooling! mode={pooling.get_pooling_mode_str()}")
+    transformer = st_model[0]
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    os.makedirs(model_dir, exist_ok=True)
+    transformer.tokenizer.save_pretrained(model_dir)
+    inputs = transformer.tokenizer(["export"], return_tensors="pt")
+    axes = {0: "batch", 1: "sequence"}
+    tmp_path = os.path.join(model_dir, MODEL_FILE_NAME + ".tmp")
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer.auto_model).eval(),
+            (inputs["input_ids"], inputs["attention_mask"]),
+            tmp_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["token_embeddings"],
+            dynamic_axes={"input_ids": axes, "attention_mask": axes, "token_embeddings": axes},
+            opset_version=14,
+        )
+    os.replace(tmp_path, os.path.join(model_dir, MODEL_FILE_NAME))
+
+    meta = {
+        "model_name": model_name,
+        "dim": st_model.get_sentence_embedding_dimension(),
+        "max_seq_length": st_model.max_seq_length,
+        "normalize": any(isinstance(module, Normalize) for module in st_model),
+    }
+    with open(os.path.join(model_dir, META_FILE_NAME), "w") as f:
+        json.dump(meta, f)
+
+    _logger.info(f"{log_prefix}: success. dir={model_dir}, elapsed={time.time() - start_time:.2f}s, meta={meta}")
+
+def quantize(model_dir):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    log_prefix = "onnx_quantize"
+
+    tmp_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE_NAME + ".tmp")
+    quantize_dynamic(os.path.join(model_dir, MODEL_FILE_NAME), tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, os.path.join(model_dir, QUANTIZED_MODEL_FILE_NAME))
+
+    _logger.info(f"{log_prefix}: success. dir={model_dir}")
+
+def prepare(model_name, onnx_dir, quantized):
+    model_dir = get_model_dir(onnx_dir, model_name)
+    if not os.path.exists(os.path.join(model_dir, META_FILE_NAME)):
+        export(model_name, model_dir)
+    if quantized and not os.path.exists(os.path.join(model_dir, QUANTIZED_MODEL_FILE_NAME)):
+        quantize(model_dir)
+    return model_dir
+
+class OnnxEmbeddingModel:
+    # drop-in for the SentenceTransformer calls the project makes (encode, get_sentence_embedding_dimension)
+    def __init__(self, model_dir, quantized, intra_op_threads=None):
+        with open(os.path.join(model_dir, META_FILE_NAME), "r") as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.max_seq_length = meta["max_seq_length"]
+        self.normalize = meta["normalize"]
+        self.backend_id = "onnx-int8" if quantized else "onnx"
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = intra_op_threads or 0
+        options.inter_op_num_threads = 1
+        model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE_NAME if quantized else MODEL_FILE_NAME)
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        input_ids = self.tokenizer(list(sentences), truncation=True, max_length=self.max_seq_length)["input_ids"]
+        lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+        # longest first, each batch padded only to its own longest text
+        order = np.argsort(-lengths, kind="stable")
+
+        vectors = np.empty((len(sentences), self.dim), dtype=np.float32)
+        for start in tqdm(range(0, len(order), batch_size), disable=not show_progress_bar):
+            rows = order[start:start + batch_size]
+            batch_ids = np.full((len(rows), lengths[rows[0]]), self.tokenizer.pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros(batch_ids.shape, dtype=np.int64)
+            for i, row in enumerate(rows):
+                batch_ids[i, :lengths[row]] = input_ids[row]
+                attention_mask[i, :lengths[row]] = 1
+
+            token_embeddings = self.session.run(None, {"input_ids": batch_ids, "attention_mask": attention_mask})[0]
+            mask = attention_mask[:, :, None].astype(np.float32)
+            vectors[rows] = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self.normalize or normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.clip(norms, 1e-12, None)
+        return vectors[0] if single else vectors
+
+def create_onnx_embedding_model(model_name, onnx_dir, quantized, intra_op_threads=None):
+    log_prefix = "create_onnx_embedding_model"
+
+    model_dir = prepare(model_name, onnx_dir, quantized)
+    start_time = time.time()
+    embedding_model = OnnxEmbeddingModel(model_dir, quantized, intra_op_threads)
+
+    _logger.info(f"{log_prefix}: success. backend={embedding_model.backend_id}, threads={intra_op_threads}, load={time.time() - start_time:.2f}s")
+    return embedding_model
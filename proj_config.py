@@ -2,15 +2,30 @@ import logging
 
 class Config:
     def __init__(self,
-        logging_level, chk_serv_timeout, chk_serv_delay, chk_serv_retries, proj_name, 
+        logging_level, chk_serv_timeout, chk_serv_backoff_max, chk_serv_deadline, proj_name, 
         data_file_path, chunk_size, chunk_model_name, embedding_model_name, elastic_index_name,
         elastic_result_num, llm_model_name, grafana_api_key_name, dashboard_file_path, ground_truth_file_path,
-        llm_results_num, llm_results_prompt_file_path, llm_results_prompt2_file_path):
+        llm_results_num, llm_results_prompt_file_path, llm_results_prompt2_file_path,
+        elastic_bulk_size, elastic_bulk_workers, elastic_refresh_interval, elastic_replicas, embedding_batch_size,
+        embedding_normalize, embedding_cache_dir, embedding_cache_max_mb, elastic_ingest_mode,
+        query_embedding_cache_size, answer_cache_enabled, answer_cache_max_entries, answer_cache_ttl,
+        answer_cache_semantic_threshold, db_pool_min_size, db_pool_max_size, db_pool_health_check_interval,
+        db_write_behind, db_write_queue_size, db_write_batch_size, db_write_flush_interval, db_write_enqueue_timeout,
+        eval_batch_size, eval_concurrency, llm_results_concurrency, knn_backend, local_index_dir,
+        local_index_mmap, keyword_backend, bm25_k1, bm25_b, hnsw_m,
+        hnsw_ef_construction, knn_num_candidates, knn_k, vector_index_type, knn_rescore_oversample,
+        embedding_backend, embedding_onnx_dir, embedding_onnx_quantize, embedding_onnx_threads,
+        elastic_connections_per_node, llm_http_pool_size, llm_http_keepalive_expiry, llm_keep_alive,
+        llm_warm_up, chk_serv_backoff_base, chk_serv_healthy_ttl, context_assembly, context_token_budget,
+        llm_request_options, chunk_workers, chunk_segment_chars, data_dir, book_id_stride,
+        book_registry_path, ingest_batch_size, ingest_queue_size, ingest_checkpoint_path, rerank_enabled,
+        rerank_model_name, rerank_candidates, rerank_top_n, rerank_budget_ms, rerank_cache_size, rerank_max_length,
+        db_pool_acquire_timeout):
 
         self.logging_level = logging_level
         self.chk_serv_timeout = chk_serv_timeout
-        self.chk_serv_delay = chk_serv_delay
-        self.chk_serv_retries = chk_serv_retries
+        self.chk_serv_backoff_max = chk_serv_backoff_max
+        self.chk_serv_deadline = chk_serv_deadline
         self.proj_name = proj_name
 
         self.data_file_path = data_file_path
@@ -29,11 +44,92 @@ class Config:
         self.llm_results_prompt_file_path = llm_results_prompt_file_path
         self.llm_results_prompt2_file_path = llm_results_prompt2_file_path
 
+        self.elastic_bulk_size = elastic_bulk_size
+        self.elastic_bulk_workers = elastic_bulk_workers
+        self.elastic_refresh_interval = elastic_refresh_interval
+        self.elastic_replicas = elastic_replicas
+        self.embedding_batch_size = embedding_batch_size
+
+        self.embedding_normalize = embedding_normalize
+        self.embedding_cache_dir = embedding_cache_dir
+        self.embedding_cache_max_mb = embedding_cache_max_mb
+        self.elastic_ingest_mode = elastic_ingest_mode
+
+        self.query_embedding_cache_size = query_embedding_cache_size
+        self.answer_cache_enabled = answer_cache_enabled
+        self.answer_cache_max_entries = answer_cache_max_entries
+        self.answer_cache_ttl = answer_cache_ttl
+        self.answer_cache_semantic_threshold = answer_cache_semantic_threshold
+
+        self.db_pool_min_size = db_pool_min_size
+        self.db_pool_max_size = db_pool_max_size
+        self.db_pool_health_check_interval = db_pool_health_check_interval
+
+        self.db_write_behind = db_write_behind
+        self.db_write_queue_size = db_write_queue_size
+        self.db_write_batch_size = db_write_batch_size
+        self.db_write_flush_interval = db_write_flush_interval
+        self.db_write_enqueue_timeout = db_write_enqueue_timeout
+
+        self.eval_batch_size = eval_batch_size
+        self.eval_concurrency = eval_concurrency
+        self.llm_results_concurrency = llm_results_concurrency
+        self.knn_backend = knn_backend
+        self.local_index_dir = local_index_dir
+
+        self.local_index_mmap = local_index_mmap
+        self.keyword_backend = keyword_backend
+        self.bm25_k1 = bm25_k1
+        self.bm25_b = bm25_b
+        self.hnsw_m = hnsw_m
+
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.knn_num_candidates = knn_num_candidates
+        self.knn_k = knn_k
+        self.vector_index_type = vector_index_type
+        self.knn_rescore_oversample = knn_rescore_oversample
+
+        self.embedding_backend = embedding_backend
+        self.embedding_onnx_dir = embedding_onnx_dir
+        self.embedding_onnx_quantize = embedding_onnx_quantize
+        self.embedding_onnx_threads = embedding_onnx_threads
+        self.elastic_connections_per_node = elastic_connections_per_node
+
+        self.llm_http_pool_size = llm_http_pool_size
+        self.llm_http_keepalive_expiry = llm_http_keepalive_expiry
+        self.llm_keep_alive = llm_keep_alive
+        self.llm_warm_up = llm_warm_up
+        self.chk_serv_backoff_base = chk_serv_backoff_base
+
+        self.chk_serv_healthy_ttl = chk_serv_healthy_ttl
+        self.context_assembly = context_assembly
+        self.context_token_budget = context_token_budget
+        self.llm_request_options = llm_request_options
+
+        self.chunk_workers = chunk_workers
+        self.chunk_segment_chars = chunk_segment_chars
+        self.data_dir = data_dir
+        self.book_id_stride = book_id_stride
+
+        self.book_registry_path = book_registry_path
+        self.ingest_batch_size = ingest_batch_size
+        self.ingest_queue_size = ingest_queue_size
+        self.ingest_checkpoint_path = ingest_checkpoint_path
+        self.rerank_enabled = rerank_enabled
+        self.rerank_model_name = rerank_model_name
+        self.rerank_candidates = rerank_candidates
+
+        self.rerank_top_n = rerank_top_n
+        self.rerank_budget_ms = rerank_budget_ms
+        self.rerank_cache_size = rerank_cache_size
+        self.rerank_max_length = rerank_max_length
+        self.db_pool_acquire_timeout = db_pool_acquire_timeout
+
 config = Config(
     logging_level=logging.DEBUG,
     chk_serv_timeout=2,
-    chk_serv_delay=5,
-    chk_serv_retries=120, # 10 min
+    chk_serv_backoff_max=5, # seconds, cap of the exponential backoff
+    chk_serv_deadline=600, # seconds (10 min)
     proj_name="detective_assistant",
 
     data_file_path="The_Adventure_of_the_Speckled_Band.txt",
@@ -50,5 +146,89 @@ config = Config(
 
     llm_results_num=20,
     llm_results_prompt_file_path="llm-results-prompt.csv",
-    llm_results_prompt2_file_path="llm-results-prompt2.csv"
+    llm_results_prompt2_file_path="llm-results-prompt2.csv",
+
+    elastic_bulk_size=500,
+    elastic_bulk_workers=4, # 1: streaming_bulk, >1: parallel_bulk
+    elastic_refresh_interval="1s",
+    elastic_replicas=0,
+    embedding_batch_size=32,
+
+    embedding_normalize=True,
+    embedding_cache_dir=".cache/embeddings", # None: disabled
+    embedding_cache_max_mb=256,
+    elastic_ingest_mode="incremental", # full: rebuild and swap alias, incremental: upsert/delete changed chunks
+
+    query_embedding_cache_size=1024,
+    answer_cache_enabled=True,
+    answer_cache_max_entries=512,
+    answer_cache_ttl=3600, # seconds
+    answer_cache_semantic_threshold=0.95, # cosine similarity
+
+    db_pool_min_size=1,
+    db_pool_max_size=10,
+    db_pool_health_check_interval=30, # seconds idle before a connection is pinged on checkout
+
+    db_write_behind=True,
+    db_write_queue_size=1000,
+    db_write_batch_size=50,
+    db_write_flush_interval=2, # seconds
+    db_write_enqueue_timeout=1, # seconds, then fall back to a synchronous write
+
+    eval_batch_size=50, # questions per msearch request
+    eval_concurrency=4,
+    llm_results_concurrency=4, # requests in flight, match OLLAMA_NUM_PARALLEL
+    knn_backend="elastic", # elastic | local (in-process numpy exact search)
+    local_index_dir=".cache/local_index",
+
+    local_index_mmap=True,
+    keyword_backend="elastic", # elastic | local (in-process bm25)
+    bm25_k1=1.2, # elasticsearch defaults
+    bm25_b=0.75,
+    hnsw_m=16, # elasticsearch defaults, applied at ingest
+
+    hnsw_ef_construction=100,
+    knn_num_candidates=100, # per-shard candidates, at least k (see sweep_knn.py)
+    knn_k=None, # neighbors collected by knn, None: the number of results requested
+    vector_index_type="hnsw", # hnsw: float32 | int8_hnsw: int8 scalar quantized (applied at ingest, see bench_quantization.py)
+    knn_rescore_oversample=None, # e.g. 2.0: collect k * oversample quantized neighbors, rescore them on the float vectors; None: off
+
+    embedding_backend="torch", # torch: sentence-transformers | onnx: onnx runtime on cpu, needs requirements-onnx.txt (see bench_onnx.py)
+    embedding_onnx_dir=".cache/onnx", # exported on first use
+    embedding_onnx_quantize=False, # dynamic int8 weights
+    embedding_onnx_threads=None, # intra-op threads, None: onnx runtime default (physical cores)
+    elastic_connections_per_node=10, # keep-alive pool shared by all app sessions
+
+    llm_http_pool_size=10, # keep-alive connections to ollama shared by all app sessions
+    llm_http_keepalive_expiry=60, # seconds
+    llm_keep_alive="30m", # how long ollama keeps the model loaded after the warm-up (match OLLAMA_KEEP_ALIVE)
+    llm_warm_up=True, # load the model into memory when the client is created
+    chk_serv_backoff_base=0.5, # seconds, first retry delay before jitter
+
+    chk_serv_healthy_ttl=30, # seconds a successful probe is trusted without probing again
+    context_assembly=True, # merge adjacent chunks, drop duplicates, enforce context_token_budget; False: concatenate all chunks
+    context_token_budget=1024, # tokens of the chunk_model_name encoding (see bench_context.py)
+    llm_request_options={ # per request type, None: server default; num_predict is sent as max_tokens (keep_alive: llm_keep_alive / OLLAMA_KEEP_ALIVE)
+        "chat": {"num_predict": 512}, # app answers (llm_stream)
+        "eval": {"num_predict": 512}, # offline generation (llm)
+    },
+
+    chunk_workers=4, # processes for chunking, 1: in-process
+    chunk_segment_chars=100000, # inputs are cut at the first paragraph break after this many characters, smaller inputs stay one segment
+    data_dir=None, # directory of *.txt books ingested after data_file_path, None: data_file_path only
+    book_id_stride=1000000, # chunk id = book number * stride + position in the book
+
+    book_registry_path=".cache/books.json", # book -> book number, kept so adding a book does not renumber the others
+    ingest_batch_size=256, # chunks per embed / bulk-index batch
+    ingest_queue_size=4, # batches buffered between pipeline stages
+    ingest_checkpoint_path=".cache/ingest_checkpoint.json", # progress of an interrupted full ingest, removed when it completes
+    rerank_enabled=False, # retrieve rerank_candidates, keep the rerank_top_n the cross-encoder scores highest (see bench_rerank.py)
+    rerank_model_name="cross-encoder/ms-marco-MiniLM-L-6-v2",
+    rerank_candidates=20,
+
+    rerank_top_n=3,
+    rerank_budget_ms=300, # per request, over budget: retriever order; None: no limit, 0: scores from the cache only
+    rerank_cache_size=4096, # (question, chunk id) scores
+    rerank_max_length=256, # tokens of question + chunk
+    db_pool_acquire_timeout=30 # seconds a caller waits for a free pooled connection
 )
@@ -1,26 +1,71 @@
-import time, socket
+import time, random, socket, threading
+from concurrent.futures import ThreadPoolExecutor
 
 from proj_config import config
 from log_util import get_logger
 
 _logger = get_logger(__name__)
 
+_healthy_until = {} # (host, port) -> time until which the last successful probe is trusted
+_healthy_lock = threading.Lock()
+
+def probe(host, port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(config.chk_serv_timeout)
+        try:
+            s.connect((host, port))
+            return True
+        except OSError:
+            return False
+
+def is_cached_healthy(host, port):
+    with _healthy_lock:
+        return _healthy_until.get((host, port), 0) > time.monotonic()
+
+def mark_unhealthy(host, port):
+    with _healthy_lock:
+        _healthy_until.pop((host, port), None)
+
+def clear_health_cache():
+    with _healthy_lock:
+        _healthy_until.clear()
+
 def check_service(host, port):
     log_prefix = "check_service"
 
+    # request-path callers skip the probe while a recent one succeeded
+    if is_cached_healthy(host, port):
+        return True
+
+    start_time = time.monotonic()
     attempt = 0
-    while attempt < config.chk_serv_retries:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(config.chk_serv_timeout)
-            try:
-                s.connect((host, port))
-
-                _logger.debug(f"{log_prefix}: success. host={host}, port={port}")
-                return True
-            except (socket.timeout, ConnectionRefusedError):
-                attempt += 1
-                _logger.debug(f"{log_prefix}: connection failed! retrying in {config.chk_serv_delay} seconds (attempt {attempt} of {config.chk_serv_retries}). host={host}, port={port}")
-                time.sleep(config.chk_serv_delay)
-
-    _logger.error(f"{log_prefix}: failed! host={host}, port={port}")
+    while True:
+        if probe(host, port):
+            with _healthy_lock:
+                _healthy_until[(host, port)] = time.monotonic() + config.chk_serv_healthy_ttl
+
+            _logger.debug(f"{log_prefix}: success. host={host}, port={port}, attempts={attempt + 1}, elapsed={time.monotonic() - start_time:.2f}s")
+            return True
+
+        remaining = config.chk_serv_deadline - (time.monotonic() - start_time)
+        if remaining <= 0:
+            break
+        # exponential backoff with full jitter, so restarted dependencies are not probed in lockstep
+        delay = min(remaining, random.uniform(0, min(config.chk_serv_backoff_max, config.chk_serv_backoff_base * 2 ** attempt)))
+        attempt += 1
+        _logger.debug(f"{log_prefix}: connection failed! retrying in {delay:.2f} seconds (attempt {attempt}). host={host}, port={port}")
+        time.sleep(delay)
+
+    _logger.error(f"{log_prefix}: failed! host={host}, port={port}, attempts={attempt + 1}")
     return False
+
+def check_services(services):
+    log_prefix = "check_services"
+
+    # all dependencies in parallel, startup waits for the slowest one instead of the sum
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, len(services))) as executor:
+        results = dict(zip(services, executor.map(lambda service: check_service(*service), services)))
+
+    _logger.info(f"{log_prefix}: {'success' if all(results.values()) else 'failed!'} elapsed={time.monotonic() - start_time:.2f}s, results={results}")
+    return results
@@ -0,0 +1,109 @@
+import time, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from sentence_transformers import CrossEncoder
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+
+_logger = get_logger(__name__)
+
+_scores = OrderedDict() # (model, question, chunk id) -> cross-encoder score
+_scores_lock = threading.Lock()
+_scores_stats = {"requests": 0, "fallbacks": 0, "hits": 0, "misses": 0, "score_time": 0.0}
+
+# one forward pass at a time (torch already uses every core); a request over budget cancels its pass if it is still queued,
+# a pass that already started finishes and fills the cache, so the queue never holds work nobody waits for
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+
+_CONFIG_BUDGET = object()
+
+def create_reranker(device="cpu"):
+    log_prefix = "create_reranker"
+
+    reranker = CrossEncoder(config.rerank_model_name, max_length=config.rerank_max_length, device=device)
+
+    _logger.info(f"{log_prefix}: success. model={config.rerank_model_name}, device={device}")
+    return reranker
+
+def _key(question, doc):
+    return (config.rerank_model_name, question, str(doc["id"]))
+
+def score(reranker, question, docs):
+    # every (question, chunk) pair in one batched forward pass
+    start_time = time.perf_counter()
+    scores = reranker.predict(
+        [(question, doc["text"]) for doc in docs],
+        batch_size=len(docs),
+        show_progress_bar=False,
+        convert_to_numpy=True,
+    )
+    score_time = time.perf_counter() - start_time
+
+    with _scores_lock:
+        for doc, doc_score in zip(docs, scores):
+            key = _key(question, doc)
+            _scores[key] = float(doc_score)
+            _scores.move_to_end(key)
+        while len(_scores) > config.rerank_cache_size:
+            _scores.popitem(last=False)
+        _scores_stats["misses"] += len(docs)
+        _scores_stats["score_time"] += score_time
+    return scores
+
+def rerank(reranker, question, docs, top_n=None, budget_ms=_CONFIG_BUDGET):
+    log_prefix = "rerank"
+
+    top_n = top_n or config.rerank_top_n
+    # None: no limit, 0: retriever order unless every score is cached
+    if budget_ms is _CONFIG_BUDGET:
+        budget_ms = config.rerank_budget_ms
+    if len(docs) <= 1:
+        return docs[:top_n]
+
+    start_time = time.perf_counter()
+    question = elastic_util.normalize_question(question)
+    with _scores_lock:
+        scores = []
+        for doc in docs:
+            key = _key(question, doc)
+            doc_score = _scores.get(key)
+            if doc_score is not None:
+                _scores.move_to_end(key)
+            scores.append(doc_score)
+        _scores_stats["requests"] += 1
+        _scores_stats["hits"] += sum(doc_score is not None for doc_score in scores)
+
+    missing = [i for i, doc_score in enumerate(scores) if doc_score is None]
+    if missing:
+        timeout = max(0.0, budget_ms / 1000 - (time.perf_counter() - start_time)) if budget_ms is not None else None
+        future = None
+        try:
+            if timeout == 0:
+                raise FutureTimeoutError()
+            future = _executor.submit(score, reranker, question, [docs[i] for i in missing])
+            for i, doc_score in zip(missing, future.result(timeout=timeout)):
+                scores[i] = float(doc_score)
+        except FutureTimeoutError:
+            cancelled = future is None or future.cancel()
+            with _scores_lock:
+                _scores_stats["fallbacks"] += 1
+            _logger.warning(f"{log_prefix}: over budget, retriever order kept. budget_ms={budget_ms}, candidates#={len(docs)}, missing#={len(missing)}, cancelled={cancelled}")
+            return docs[:top_n]
+
+    # sorted is stable, equal scores keep the retriever order
+    order = sorted(range(len(docs)), key=lambda i: -scores[i])
+    elapsed = time.perf_counter() - start_time
+
+    _logger.debug(f"{log_prefix}: success. candidates#={len(docs)}, scored#={len(missing)}, top_n={top_n}, elapsed={elapsed * 1000:.1f}ms, ranks={order[:top_n]}")
+    return [docs[i] for i in order[:top_n]]
+
+def get_rerank_stats():
+    with _scores_lock:
+        return dict(_scores_stats, size=len(_scores))
+
+def clear_rerank_cache():
+    with _scores_lock:
+        _scores.clear()
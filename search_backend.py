@@ -0,0 +1,99 @@
+import os, threading
+
+import numpy as np
+
+from proj_config import config
+from log_util import get_logger
+from vector_index import VectorIndex, VectorIndexWriter, DOCS_FILE_NAME
+from bm25_index import BM25Index, ARRAYS_FILE_NAME
+
+_logger = get_logger(__name__)
+
+class SearchBackend:
+    # hits use the elasticsearch layout ({"_id", "_score", "_source"}), one hit list per query
+    name = None
+
+    def knn(self, query_vectors, k, book=None):
+        raise NotImplementedError(f"{self.name} backend has no knn search")
+
+    def keyword(self, questions, k, book=None):
+        raise NotImplementedError(f"{self.name} backend has no keyword search")
+
+class LocalBackend(SearchBackend):
+    name = "local"
+
+    def __init__(self, vector_index, bm25_index=None):
+        self.vector_index = vector_index
+        self.bm25_index = bm25_index
+        self._book_rows = None
+
+    def book_rows(self, book):
+        if book is None:
+            return None
+        if self._book_rows is None:
+            book_rows = {}
+            for row, doc in enumerate(self.vector_index.docs):
+                book_rows.setdefault(doc.get("book"), []).append(row)
+            self._book_rows = {key: np.array(rows, dtype=np.int64) for key, rows in book_rows.items()}
+        return self._book_rows.get(book, np.zeros(0, dtype=np.int64))
+
+    def _hit(self, row, score):
+        doc = self.vector_index.docs[row]
+        return {
+            "_id": str(doc["id"]),
+            "_score": float(score),
+            "_source": {"text": doc["text"], "id": doc["id"]},
+        }
+
+    def knn(self, query_vectors, k, book=None):
+        top, top_scores = self.vector_index.search(query_vectors, k, self.book_rows(book))
+        # same scale as the elasticsearch cosine similarity score
+        return [[self._hit(row, (1.0 + score) / 2.0) for row, score in zip(rows, scores)] for rows, scores in zip(top, top_scores)]
+
+    def keyword(self, questions, k, book=None):
+        if self.bm25_index is None:
+            return super().keyword(questions, k, book)
+
+        results = []
+        book_rows = self.book_rows(book)
+        for question in questions:
+            rows, scores = self.bm25_index.search(question, k, book_rows)
+            results.append([self._hit(row, score) for row, score in zip(rows, scores)])
+        return results
+
+_local_backend = None
+_local_backend_mtime = None
+_local_backend_lock = threading.Lock()
+
+class LocalIndexWriter:
+    # vectors go to disk batch by batch, the index is published on close
+    def __init__(self):
+        self.vector_writer = VectorIndexWriter(config.local_index_dir)
+
+    def append(self, vectors, docs):
+        self.vector_writer.append(vectors, docs)
+
+    def abort(self):
+        self.vector_writer.abort()
+
+    def close(self):
+        # docs.json goes last, it is the file get_local_backend watches, so a reload never pairs new docs with old bm25 arrays
+        BM25Index.build([doc["text"] for doc in self.vector_writer.docs], config.bm25_k1, config.bm25_b).save(config.local_index_dir)
+        self.vector_writer.close()
+
+def check_local_index():
+    return os.path.exists(os.path.join(config.local_index_dir, DOCS_FILE_NAME))
+
+def get_local_backend():
+    global _local_backend, _local_backend_mtime
+
+    # reloaded when ingest rewrites the index files, docs.json is replaced after the others
+    mtime = os.path.getmtime(os.path.join(config.local_index_dir, DOCS_FILE_NAME))
+    with _local_backend_lock:
+        if _local_backend is None or mtime != _local_backend_mtime:
+            bm25_index = None
+            if os.path.exists(os.path.join(config.local_index_dir, ARRAYS_FILE_NAME)):
+                bm25_index = BM25Index.load(config.local_index_dir, config.bm25_k1, config.bm25_b)
+            _local_backend = LocalBackend(VectorIndex.load(config.local_index_dir, mmap=config.local_index_mmap), bm25_index)
+            _local_backend_mtime = mtime
+        return _local_backend
@@ -0,0 +1,117 @@
+import os, argparse, itertools
+
+import numpy as np
+import pandas as pd
+
+from proj_config import config
+from log_util import get_logger
+import elastic_util
+import llm_util
+import ingest
+import eval_retrieval
+from vector_index import VectorIndex
+
+_logger = get_logger(__name__)
+
+M_GRID = [8, 16, 32]
+EF_CONSTRUCTION_GRID = [50, 100, 200]
+NUM_CANDIDATES_GRID = [10, 25, 50, 100, 200, 500]
+
+def build_sweep_index(es_client, local_index, m, ef_construction, index_type="hnsw"):
+    log_prefix = "build_sweep_index"
+
+    index_name = f"{config.elastic_index_name}_sweep_{index_type}_m{m}_ef{ef_construction}"
+    properties = {
+        "text": {"type": "text"},
+        "vector": ingest.vector_mapping(local_index.vectors.shape[1], m, ef_construction, index_type),
+        "id": {"type": "keyword"},
+    }
+    es_client.indices.delete(index=index_name, ignore_unavailable=True)
+    es_client.indices.create(index=index_name, body={
+        "settings": {"number_of_shards": 1, "number_of_replicas": 0, "refresh_interval": "-1"},
+        "mappings": {"properties": properties},
+    })
+    docs = ({"text": doc["text"], "vector": local_index.vectors[i], "id": doc["id"]} for i, doc in enumerate(local_index.docs))
+    elastic_util.bulk_index(es_client, index_name, elastic_util._bulk_actions(index_name, docs))
+    # one segment, so the graph being measured is the one built with these parameters
+    es_client.indices.forcemerge(index=index_name, max_num_segments=1)
+    es_client.indices.refresh(index=index_name)
+
+    _logger.info(f"{log_prefix}: success. index={index_name}")
+    return index_name
+
+def run_knn(es_client, index_name, vectors, k, num_candidates):
+    results = []
+    latencies = []
+    for start in range(0, len(vectors), config.eval_batch_size):
+        searches = []
+        for v in vectors[start:start + config.eval_batch_size]:
+            searches.extend([{}, {
+                "knn": {"field": "vector", "query_vector": v, "k": k, "num_candidates": num_candidates},
+                "size": k,
+                "_source": ["id"],
+            }])
+        for response in es_client.msearch(index=index_name, searches=searches)["responses"]:
+            results.append([hit["_source"]["id"] for hit in response["hits"]["hits"]])
+            latencies.append(response["took"])
+    return results, np.array(latencies, dtype=np.float64)
+
+def sweep_num_candidates(es_client, index_name, vectors, exact_ids, doc_ids, k):
+    rows = []
+    for num_candidates in NUM_CANDIDATES_GRID:
+        if num_candidates < k:
+            continue
+        results, latencies = run_knn(es_client, index_name, vectors, k, num_candidates)
+        recall = float(np.mean([len(set(ids) & set(exact)) / k for ids, exact in zip(results, exact_ids)]))
+        relevance = eval_retrieval.relevance_matrix([[{"id": doc_id} for doc_id in ids] for ids in results], doc_ids, k)
+        rows.append({
+            "num_candidates": num_candidates,
+            f"recall@{k}": recall,
+            "hit_rate": eval_retrieval.hit_rate(relevance),
+            "mrr": eval_retrieval.mrr(relevance),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+        })
+    return rows
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--query-only", action="store_true", help="sweep num_candidates on the live index, no rebuilds")
+    args = parser.parse_args()
+
+    elastic_util.ELASTIC_HOST = "localhost"
+    elastic_util.ELASTIC_PORT = int(os.getenv("ELASTIC_LOCAL_PORT", 9200))
+
+    df_ground_truth = pd.read_csv(config.ground_truth_file_path)
+    questions = df_ground_truth["question"].tolist()
+    doc_ids = df_ground_truth["document"].tolist()
+
+    es_client = elastic_util.create_client()
+    embedding_model = llm_util.create_embedding_model()
+    vectors = eval_retrieval.encode_questions(embedding_model, questions)
+
+    # exact cosine top-k over the ingested vectors is the reference for recall
+    k = config.elastic_result_num
+    local_index = VectorIndex.load(config.local_index_dir, mmap=False)
+    exact_rows, _ = local_index.search(vectors, k)
+    exact_ids = [[local_index.docs[row]["id"] for row in rows] for rows in exact_rows]
+
+    rows = []
+    if args.query_only:
+        for row in sweep_num_candidates(es_client, config.elastic_index_name, vectors, exact_ids, doc_ids, k):
+            rows.append(dict(m="live", ef_construction="live", **row))
+    else:
+        for m, ef_construction in itertools.product(M_GRID, EF_CONSTRUCTION_GRID):
+            index_name = build_sweep_index(es_client, local_index, m, ef_construction)
+            try:
+                for row in sweep_num_candidates(es_client, index_name, vectors, exact_ids, doc_ids, k):
+                    rows.append(dict(m=m, ef_construction=ef_construction, **row))
+            finally:
+                es_client.indices.delete(index=index_name, ignore_unavailable=True)
+
+    df_sweep = pd.DataFrame(rows)
+    _logger.info(f"knn sweep (k={k}, questions#={len(questions)}):\n{df_sweep.round(3).to_string(index=False)}")
@@ -0,0 +1,101 @@
+import os, json
+
+import numpy as np
+
+from log_util import get_logger
+
+_logger = get_logger(__name__)
+
+VECTORS_FILE_NAME = "vectors.npy"
+DOCS_FILE_NAME = "docs.json"
+
+class VectorIndex:
+    def __init__(self, vectors, docs):
+        # rows are unit length, so cosine similarity is a dot product
+        self.vectors = vectors
+        self.docs = docs
+
+    @classmethod
+    def build(cls, vectors, docs):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return cls(np.ascontiguousarray(vectors / norms), docs)
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        log_prefix = "vector_index_load"
+
+        vectors = np.load(os.path.join(index_dir, VECTORS_FILE_NAME), mmap_mode="r" if mmap else None)
+        with open(os.path.join(index_dir, DOCS_FILE_NAME), "r") as f:
+            docs = json.load(f)
+
+        _logger.info(f"{log_prefix}: success. dir={index_dir}, shape={vectors.shape}, mmap={mmap}")
+        return cls(vectors, docs)
+
+    def search(self, query_vectors, k, rows=None):
+        if rows is not None:
+            # search a subset (e.g. one book), results are mapped back to index rows
+            top, top_scores = VectorIndex(self.vectors[rows], None).search(query_vectors, k)
+            return np.asarray(rows)[top], top_scores
+
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        norms = np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        scores = (query_vectors / norms) @ self.vectors.T
+
+        k = min(k, scores.shape[1])
+        if k == 0:
+            return np.zeros((len(query_vectors), 0), dtype=np.int64), np.zeros((len(query_vectors), 0), dtype=np.float32)
+
+        # unordered top-k in O(n), then sort only those k
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+class VectorIndexWriter:
+    # rows are appended to a raw file batch by batch, only the docs stay in memory until close
+    def __init__(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.raw_path = os.path.join(index_dir, VECTORS_FILE_NAME + ".raw")
+        self.docs = []
+        self.dim = None
+        self._file = open(self.raw_path, "wb")
+
+    def append(self, vectors, docs):
+        index = VectorIndex.build(vectors, docs)
+        self.dim = index.vectors.shape[1]
+        self._file.write(index.vectors.tobytes())
+        self.docs.extend(docs)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.raw_path)
+
+    def close(self, block_rows=65536):
+        log_prefix = "vector_index_writer_close"
+
+        self._file.close()
+        shape = (len(self.docs), self.dim or 0)
+        vectors_path = os.path.join(self.index_dir, VECTORS_FILE_NAME)
+        docs_path = os.path.join(self.index_dir, DOCS_FILE_NAME)
+        if shape[0] and shape[1]:
+            # .npy header in front of the raw rows, copied block by block
+            raw = np.memmap(self.raw_path, dtype=np.float32, mode="r", shape=shape)
+            out = np.lib.format.open_memmap(vectors_path + ".tmp", mode="w+", dtype=np.float32, shape=shape)
+            for start in range(0, shape[0], block_rows):
+                out[start:start + block_rows] = raw[start:start + block_rows]
+            out.flush()
+            del raw, out
+        else:
+            with open(vectors_path + ".tmp", "wb") as f:
+                np.save(f, np.zeros(shape, dtype=np.float32))
+        with open(docs_path + ".tmp", "w") as f:
+            json.dump(self.docs, f)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(docs_path + ".tmp", docs_path)
+        os.remove(self.raw_path)
+
+        _logger.info(f"{log_prefix}: success. dir={self.index_dir}, shape={shape}")